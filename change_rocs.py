@@ -0,0 +1,132 @@
+import os, sys, json, time, numpy, scene_registry
+import multiprocessing as mp
+from PIL import Image
+from os.path import basename, splitext
+from glob import glob
+from optparse import OptionParser
+
+############################################
+# change_rocs.py
+# ROC curves and AUC of every change detection result directory
+# (change/change_imgs/results_*/cd_NxN/*.tiff) against the ground truth
+# masks (change/gt/*_<imgnum>.png) of a scene, no boxm2 needed.
+# Change probabilities are accumulated into positive/negative histograms
+# (one pass per image, no rethresholding), images are read in row chunks
+# on a process pool.  Writes change/roc_report.json, roc_report.txt and
+# roc_report.png per scene.
+############################################
+
+def gt_number(gtFile):
+  """ image number of a ground truth file (<prefix>_<imgnum>.ext) """
+  imgnum, ext = splitext( basename(gtFile) )
+  return imgnum.split("_")[1]
+
+def histogram_pair(task):
+  """ positive/negative change score histograms of one change image """
+  cdFile, gtFile, nBins, lo, hi, chunkRows = task
+  cd = numpy.asarray( Image.open(cdFile), dtype=numpy.float32 )
+  gt = numpy.asarray( Image.open(gtFile) )
+  if gt.ndim == 3:
+    gt = gt[:,:,0]
+  assert cd.shape[:2] == gt.shape[:2], "%s and %s differ in size"%(cdFile, gtFile)
+  pos = numpy.zeros(nBins, dtype=numpy.int64)
+  neg = numpy.zeros(nBins, dtype=numpy.int64)
+  scale = nBins / float(hi - lo)
+  for r0 in range(0, cd.shape[0], chunkRows):
+    scores = cd[r0:r0+chunkRows].ravel()
+    changed = gt[r0:r0+chunkRows].ravel() > 0
+    bins = numpy.clip( ((scores - lo) * scale).astype(numpy.int64), 0, nBins-1 )
+    pos += numpy.bincount(bins[changed], minlength=nBins)
+    neg += numpy.bincount(bins[~changed], minlength=nBins)
+  return pos, neg
+
+def roc_from_histograms(pos, neg):
+  """ (fpr, tpr, auc), thresholds sweep from the highest bin down """
+  tp = numpy.r_[0, numpy.cumsum(pos[::-1])].astype(numpy.float64)
+  fp = numpy.r_[0, numpy.cumsum(neg[::-1])].astype(numpy.float64)
+  tpr = tp / tp[-1] if tp[-1] > 0 else tp
+  fpr = fp / fp[-1] if fp[-1] > 0 else fp
+  return fpr, tpr, numpy.trapz(tpr, fpr)
+
+def scene_tasks(sceneRoot, nBins, lo, hi, chunkRows):
+  """ (result dir, task) for every change image that has a ground truth mask """
+  gts = dict( (gt_number(g), g) for g in glob(sceneRoot + "/change/gt/*.png") )
+  tasks = []
+  for resDir in sorted( glob(sceneRoot + "/change/change_imgs/results_*/cd_*") ):
+    for cdFile in sorted( glob(resDir + "/*.tiff") ):
+      imgnum, ext = splitext( basename(cdFile) )
+      if imgnum in gts:
+        tasks.append( (resDir, (cdFile, gts[imgnum], nBins, lo, hi, chunkRows)) )
+  return tasks
+
+def write_report(sceneRoot, results, maxPoints=200, plot=True):
+  """ json (auc + downsampled curve), text table and plot of every result dir """
+  outBase = sceneRoot + "/change/roc_report"
+  report = {}
+  lines = [ "%-50s %6s %8s"%("result", "images", "auc") ]
+  for name in sorted(results, key=lambda k: -results[k]["auc"]):
+    r = results[name]
+    idx = numpy.unique( numpy.linspace(0, len(r["fpr"])-1, maxPoints).astype(int) )
+    report[name] = { "auc" : float(r["auc"]), "images" : r["images"],
+                     "fpr" : r["fpr"][idx].tolist(), "tpr" : r["tpr"][idx].tolist() }
+    lines.append( "%-50s %6d %8.4f"%(name, r["images"], r["auc"]) )
+  json.dump(report, open(outBase + ".json", 'w'), indent=2)
+  open(outBase + ".txt", 'w').write( "\n".join(lines) + "\n" )
+  print "\n".join(lines)
+
+  if plot:
+    import matplotlib
+    matplotlib.use("Agg")
+    import pylab
+    pylab.figure()
+    for name in sorted(report):
+      line = pylab.plot( report[name]["fpr"], report[name]["tpr"] )
+      pylab.setp(line, label="%s (%.3f)"%(name, report[name]["auc"]))
+    pylab.legend(loc="lower right", fontsize="small")
+    pylab.xlabel("false positive rate")
+    pylab.ylabel("true positive rate")
+    pylab.title("Change Detection ROC Comparison: " + basename(sceneRoot.rstrip("/")))
+    pylab.savefig(outBase + ".png")
+
+if __name__ == "__main__":
+  parser = OptionParser()
+  parser.add_option("-s", "--scenes", action="store", type="string", dest="scenes", help="comma separated scene names")
+  parser.add_option("-b", "--bins", action="store", type="int", dest="bins", default=1000, help="number of score histogram bins (ROC resolution)")
+  parser.add_option("-r", "--range", action="store", type="string", dest="range", default="0:1", help="change score range low:high")
+  parser.add_option("-c", "--chunkRows", action="store", type="int", dest="chunkRows", default=256, help="rows of an image histogrammed at a time")
+  parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", default=-1, help="number of processes (-1 = all cpus)")
+  parser.add_option("-n", "--noplot", action="store_true", dest="noplot", default=False, help="skip the roc plot")
+  (options, args) = parser.parse_args()
+  print options
+  if not options.scenes:
+    print "No scenes given (-s)"
+    sys.exit(-1)
+  lo, hi = [ float(v) for v in options.range.split(":") ]
+  pool = mp.Pool(options.jobs if options.jobs > 0 else mp.cpu_count())
+
+  for sceneName in options.scenes.split(","):
+    sceneRoot = scene_registry.scene_root(sceneName)
+    tasks = scene_tasks(sceneRoot, options.bins, lo, hi, options.chunkRows)
+    if not tasks:
+      print "No change images with ground truth in ", sceneRoot
+      continue
+    start = time.time()
+
+    #accumulate histograms per result directory
+    hists = {}
+    for (resDir, task), (pos, neg) in zip(tasks, pool.imap(histogram_pair, [t for r, t in tasks])):
+      name = resDir.split("/")[-2] + "/" + resDir.split("/")[-1]
+      if name not in hists:
+        hists[name] = [ numpy.zeros(options.bins, dtype=numpy.int64), numpy.zeros(options.bins, dtype=numpy.int64), 0 ]
+      hists[name][0] += pos
+      hists[name][1] += neg
+      hists[name][2] += 1
+
+    results = {}
+    for name, (pos, neg, count) in hists.iteritems():
+      fpr, tpr, auc = roc_from_histograms(pos, neg)
+      results[name] = { "fpr" : fpr, "tpr" : tpr, "auc" : auc, "images" : count }
+    print "%s: %d images in %.2f s"%(sceneName, len(tasks), time.time()-start)
+    write_report(sceneRoot, results, plot=not options.noplot)
+  pool.close()
+  pool.join()
@@ -0,0 +1,165 @@
+import numpy as np
+import pylab as pl
+from sklearn import datasets
+from SoftmaxReg import SoftmaxReg, softmax
+
+class ApproxSVM():
+    """ Approximate RBF kernel classifier.  Features are mapped into an
+        explicit approximation of the RBF kernel space exp(-gamma |x-y|^2),
+        either random Fourier features (method="rff") or a Nystroem map onto
+        n_components landmark samples (method="nystroem"), and a linear
+        softmax classifier is trained on the mapped features with mini-batch
+        AdaGrad.  Batches are mapped as they are visited, so memory does not
+        grow with the kernel dimension times the sample count.
+
+        After training the linear weights are folded into the map, so
+        prediction is one kernel/cosine basis evaluation followed by a single
+        matrix multiply.  Same fit/predict_proba interface as SoftmaxReg.
+    """
+    def __init__(self, method="rff", gamma=.7, n_components=300, alpha=.1,
+                 batch_size=256, n_epochs=5, learning_rate=.5, seed=0,
+                 blockRows=4096):
+        if method not in ("rff", "nystroem"):
+            raise ValueError("Unknown kernel approximation %s"%method)
+        self.method = method
+        self.gamma = gamma
+        self.n_components = n_components
+        self.alpha = alpha
+        self.batch_size = batch_size or 256
+        self.n_epochs = n_epochs
+        self.learning_rate = learning_rate
+        self.seed = seed
+        self.blockRows = blockRows
+
+    def fit(self, x_train, y_train):
+        """ Assumes classes are encoded starting at 0 """
+        y_train = np.asarray(y_train, dtype=int)
+        self.classes = set(y_train)
+        self.fit_map(x_train)
+        self.linear = None
+
+        # mini-batches over contiguous row blocks, visited in random order
+        rng = np.random.RandomState(self.seed)
+        starts = np.arange(0, x_train.shape[0], self.batch_size)
+        classes = range(y_train.max() + 1)
+        for epoch in range(self.n_epochs):
+            for start in rng.permutation(starts):
+                end = start + self.batch_size
+                self._linear_step(x_train[start:end], y_train[start:end],
+                                  classes, x_train.shape[0])
+        self.fold()
+        return self
+
+    def partial_fit(self, x, y, classes=None, n_total=None):
+        """ Streams one chunk of data through (in row order, shuffle the
+        chunks).  The kernel map is drawn from the first chunk (its rows are
+        the Nystroem landmarks), classes (all class ids) must be given on
+        the first call unless the first chunk contains every class. """
+        y = np.asarray(y, dtype=int)
+        if getattr(self, "linear", None) is None:
+            self.classes = set(classes if classes is not None else y)
+            self.fit_map(x)
+            self.linear = None
+        for start in range(0, x.shape[0], self.batch_size):
+            end = start + self.batch_size
+            self._linear_step(x[start:end], y[start:end], sorted(self.classes), n_total)
+        self.fold()
+        return self
+
+    def _linear_step(self, x, y, classes, n_total):
+        """ One step of the linear softmax model on a mapped batch """
+        if self.linear is None:
+            self.linear = SoftmaxReg(alpha=self.alpha, batch_size=self.batch_size,
+                                     learning_rate=self.learning_rate)
+        self.linear.partial_fit(self.transform(x), y, classes, n_total)
+
+    def fit_map(self, x):
+        """ Draws the random Fourier frequencies/phases, or the Nystroem
+        landmarks and their whitening matrix """
+        rng = np.random.RandomState(self.seed)
+        d = x.shape[1]
+        if self.method == "rff":
+            self.basis = rng.normal(scale=np.sqrt(2*self.gamma), size=(d, self.n_components))
+            self.offset = rng.uniform(0, 2*np.pi, size=self.n_components)
+            self.normalization = np.sqrt(2.0/self.n_components)
+        else:
+            n = min(self.n_components, x.shape[0])
+            idx = np.sort(rng.choice(x.shape[0], n, replace=False))
+            self.basis = np.asarray(x[idx], dtype=np.float64).T
+            self.offset = (self.basis**2).sum(0)
+            # K_mm^(-1/2), ignoring directions with (numerically) zero spectrum
+            U, S, V = np.linalg.svd(self.kernel(self.basis.T))
+            S = np.maximum(S, 1e-12)
+            self.normalization = np.dot(U / np.sqrt(S), V)
+            self.n_components = n
+
+    def kernel(self, x):
+        """ Unnormalized basis of x: cos(x Omega + phase) for rff, the RBF
+        kernel against the landmarks for nystroem """
+        z = np.dot(np.asarray(x, dtype=np.float64), self.basis)
+        if self.method == "rff":
+            z += self.offset
+            return np.cos(z, z)
+        z *= -2.0
+        z += (np.asarray(x, dtype=np.float64)**2).sum(1)[:,np.newaxis]
+        z += self.offset
+        np.maximum(z, 0, z)
+        z *= -self.gamma
+        return np.exp(z, z)
+
+    def transform(self, x):
+        """ Explicit (approximate) kernel space features of x """
+        return np.dot(self.kernel(x), self.normalization)
+
+    def fold(self):
+        """ coef/intercept so scores are kernel(x) . coef + intercept """
+        self.coef = np.dot(self.normalization, self.linear.W)
+        self.intercept = self.linear.b
+        self.n_classes = len(self.intercept)
+
+    def predict_proba(self, x_test):
+        """ computes probabilities given features x_test, a block of rows at a time
+        """
+        nTest = x_test.shape[0]
+        p_y = np.empty( (nTest, self.n_classes+1) )
+        for r0 in range(0, nTest, self.blockRows):
+            z = np.dot(self.kernel(x_test[r0:r0+self.blockRows]), self.coef)
+            z += self.intercept
+            p_y[r0:r0+self.blockRows,:-1] = softmax(z)
+
+        #null category: probability that no class is confident
+        p_y[:,-1] = 1.0 - p_y[:,:-1].max(1)
+        return p_y
+
+    def predict(self, x_test):
+        probas = self.predict_proba(x_test)
+        return probas.argmax(1)
+
+
+# Test on synthetic data
+if __name__ == "__main__":
+
+    X, y = datasets.make_moons(n_samples=2000, noise=.1)
+
+    #train approximate svm
+    clf = ApproxSVM(gamma=2.0)
+    clf.fit(X,y)
+
+    # Plot the decision boundary. For that, we will asign a color to each
+    # point in the mesh [x_min, m_max]x[y_min, y_max].
+    h = .02
+    x_min, x_max = X[:, 0].min() - 1, X[:, 0].max() + 1
+    y_min, y_max = X[:, 1].min() - 1, X[:, 1].max() + 1
+    xx, yy = np.meshgrid(np.arange(x_min, x_max, h), np.arange(y_min, y_max, h))
+    Z = clf.predict(np.c_[xx.ravel(), yy.ravel()])
+
+    # Put the result into a color plot
+    Z = Z.reshape(xx.shape)
+    pl.set_cmap(pl.cm.Paired)
+    pl.pcolormesh(xx, yy, Z)
+
+    # Plot also the training points
+    pl.scatter(X[:, 0], X[:, 1], c=y)
+    pl.title('Approximate RBF SVM')
+    pl.axis('tight')
+    pl.show()
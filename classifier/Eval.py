@@ -1,6 +1,116 @@
 import StringIO, locale
+import numpy as np
 locale.setlocale(locale.LC_NUMERIC, "")
 
+############################################
+#ROC curves
+############################################
+def roc_curves(Y, probs):
+  """ ROC curve for every class column of probs in one pass: a single
+      argsort of the whole probability matrix, then cumulative true/false
+      positive counts per column (class c is positive where Y == c).
+      Returns a list of (fpr, tpr, thresholds, auc), one per column.
+  """
+  nPix, nClasses = probs.shape
+  cols = np.arange(nClasses)
+  order = np.argsort(-probs, axis=0, kind="mergesort")
+  scores = probs[order, cols]
+  tps = np.cumsum(np.asarray(Y)[order] == cols, axis=0)
+  fps = np.arange(1, nPix+1)[:,np.newaxis] - tps
+
+  curves = []
+  for c in cols:
+    #one point per distinct score (the last of each run of ties)
+    last = np.r_[np.nonzero(np.diff(scores[:,c]))[0], nPix-1]
+    tp = np.r_[0, tps[last,c]].astype(np.float64)
+    fp = np.r_[0, fps[last,c]].astype(np.float64)
+    tpr = tp / tp[-1] if tp[-1] > 0 else tp
+    fpr = fp / fp[-1] if fp[-1] > 0 else fp
+    thresholds = np.r_[scores[0,c] + 1, scores[last,c]]
+    curves.append( (fpr, tpr, thresholds, np.trapz(tpr, fpr)) )
+  return curves
+
+############################################
+#streaming metrics
+############################################
+class MetricsAccumulator:
+  """ Incremental confusion matrix, per class accuracy and per class score
+      histograms (for ROC curves).  update() consumes batches of true labels
+      and class probabilities, merge() adds up partial results (e.g. from
+      other workers).  Memory is O(classes^2 + classes*nBins), independent
+      of the number of samples.
+  """
+  def __init__(self, nClasses, nBins=1000):
+    self.nClasses = nClasses
+    self.nBins = nBins
+    self.confusion = np.zeros( (nClasses, nClasses), dtype=np.int64 )
+    #histograms of each column's scores, split by whether Y is that class
+    self.posHist = np.zeros( (nClasses, nBins), dtype=np.int64 )
+    self.negHist = np.zeros( (nClasses, nBins), dtype=np.int64 )
+
+  def update(self, Y, probs):
+    """ Adds a batch of true labels Y (ints) and probabilities (nPix x nClasses).
+        Models without a null column (svm.SVC) give fewer than nClasses
+        columns, the missing ones are scored 0.
+    """
+    K = self.nClasses
+    Y = np.asarray(Y, dtype=np.int64)
+    if probs.shape[1] > K or (len(Y) > 0 and Y.max() >= K):
+      raise ValueError("labels/probabilities exceed %d classes"%K)
+    if probs.shape[1] < K:
+      probs = np.hstack( (probs, np.zeros( (probs.shape[0], K-probs.shape[1]) )) )
+    pred = probs.argmax(1)
+    self.confusion += np.bincount(Y*K + pred, minlength=K*K).reshape( (K,K) )
+
+    #bin index of every score, offset per column
+    bins = np.clip( (probs*self.nBins).astype(np.int64), 0, self.nBins-1 )
+    bins += np.arange(K) * self.nBins
+    isPos = Y[:,np.newaxis] == np.arange(K)
+    self.posHist += np.bincount(bins[isPos], minlength=K*self.nBins).reshape( (K, self.nBins) )
+    self.negHist += np.bincount(bins[~isPos], minlength=K*self.nBins).reshape( (K, self.nBins) )
+    return self
+
+  def merge(self, other):
+    """ Adds another accumulator's counts into this one """
+    assert (other.nClasses, other.nBins) == (self.nClasses, self.nBins)
+    self.confusion += other.confusion
+    self.posHist += other.posHist
+    self.negHist += other.negHist
+    return self
+
+  def class_accuracy(self):
+    """ Fraction of each true class predicted correctly (nan if unseen) """
+    support = self.confusion.sum(1).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+      return np.diag(self.confusion) / support
+
+  def roc(self, c):
+    """ (fpr, tpr, auc) for column c, thresholds at the histogram bin edges """
+    tp = np.r_[0, np.cumsum(self.posHist[c][::-1])].astype(np.float64)
+    fp = np.r_[0, np.cumsum(self.negHist[c][::-1])].astype(np.float64)
+    tpr = tp / tp[-1] if tp[-1] > 0 else tp
+    fpr = fp / fp[-1] if fp[-1] > 0 else fp
+    return fpr, tpr, np.trapz(tpr, fpr)
+
+  def report(self, labels):
+    """ Precision/recall/f1/support table (like sklearn's classification_report) """
+    tp = np.diag(self.confusion).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+      precision = np.nan_to_num( tp / self.confusion.sum(0) )
+      recall = np.nan_to_num( tp / self.confusion.sum(1) )
+      f1 = np.nan_to_num( 2*precision*recall / (precision+recall) )
+    support = self.confusion.sum(1)
+    width = max(len(l) for l in labels + ["avg / total"])
+    lines = [ "%s  %9s %9s %9s %9s"%("".rjust(width), "precision", "recall", "f1-score", "support"), "" ]
+    for c, label in enumerate(labels):
+      lines.append( "%s  %9.2f %9.2f %9.2f %9d"%(label.rjust(width), precision[c], recall[c], f1[c], support[c]) )
+    total = max(support.sum(), 1)
+    lines.append("")
+    lines.append( "%s  %9.2f %9.2f %9.2f %9d"%("avg / total".rjust(width), np.dot(precision, support)/total,
+                  np.dot(recall, support)/total, np.dot(f1, support)/total, support.sum()) )
+    return "\n".join(lines)
+
+
 ############################################
 #confusion matrix printing
 ############################################
@@ -13,23 +123,15 @@ def __format_num(num):
     except (ValueError, TypeError):
       return str(num)
 
-def __get_max_width(table, index):
-    """Get the maximum width of the given column index"""
-    return max([len(__format_num(row[index])) for row in table])
-
 def printConfusionMatrix(mat, labels):
   assert mat.shape[0] == len(labels)
-  labMat = [ ["   "]+labels ]
+  #format every cell once
+  labMat = [ ["   "]+list(labels) ]
   for idx, row in enumerate(mat):
-    r = [ labels[idx]+"_true" ] 
-    for n in row:
-      r.append(n)
-    labMat.append(r)
+    labMat.append( [ labels[idx]+"_true" ] + [ __format_num(n) for n in row ] )
 
   #get column paddings
-  col_paddings = []
-  for i in range(len(labMat[0])):
-    col_paddings.append(__get_max_width(labMat, i))
+  col_paddings = [ max(len(row[i]) for row in labMat) for i in range(len(labMat[0])) ]
   
   out = StringIO.StringIO()
   for row in labMat:
@@ -37,9 +139,24 @@ def printConfusionMatrix(mat, labels):
     print >> out, row[0].ljust(col_paddings[0] + 1),
     # rest of the cols
     for i in range(1, len(row)):
-      col = __format_num(row[i]).rjust(col_paddings[i] + 2)
+      col = row[i].rjust(col_paddings[i] + 2)
       print >> out, col,
     print >> out 
   print out.getvalue()  
 
 
+# Regression check: svm.SVC has no null column, test data has noclass pixels
+if __name__ == "__main__":
+  from utils import RGBIDataset
+  from models import build_model
+  training = RGBIDataset("data/train_small.txt", maxPerClass=500)
+  testing = RGBIDataset("data/test_small.txt", includeNull=True)
+  reducer, model = build_model("svm_lda")
+  model.fit(reducer.features(training.pixels, training.target), training.target)
+  probs = model.predict_proba(reducer.features(testing.pixels))
+  assert probs.shape[1] < len(testing.intToClass)
+  acc = MetricsAccumulator(max(len(testing.intToClass), probs.shape[1]))
+  acc.update(testing.target, probs)
+  printConfusionMatrix(acc.confusion, testing.intToClass)
+  print acc.report(testing.intToClass)
+  assert acc.confusion.sum() == len(testing.target)
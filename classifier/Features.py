@@ -1,5 +1,6 @@
 import numpy as np
 import pylab as pl
+import os, pickle, hashlib
 from sklearn.decomposition import PCA
 from sklearn.lda import LDA
 
@@ -8,70 +9,281 @@ Feature transform classes (reducers).  Takes RGBI data and returns
 either reduced by LDA/PCA or just naive features.
 
 Naive features are normalized pixel intensities and differences
+
+Reducers fit once (fit) and then project (transform); features() keeps
+the old fit-if-gt-given behavior.  With cache_dir set, fitted LDA/PCA
+projections are stored on disk keyed by a hash of the training pixels,
+labels and parameters, so repeated experiments reuse them.
 """
 
 class LDAFeatures:
-  def __init__(self, n_comp=3):
+  def __init__(self, n_comp=3, cache_dir=None):
     self.lda = None
     self.n_comp = n_comp
+    self.cache_dir = cache_dir
+
+  def fit(self, pixels, gt, fullFeatures=None):
+    """ Fits (or loads from cache) the LDA projection """
+    key = cache_key(self, pixels, gt, fullFeatures)
+    self.lda = load_cached(self, key)
+    if self.lda is None:
+      if fullFeatures is None:
+        fullFeatures = naive_features(pixels)
+      self.lda = LDA(n_components=self.n_comp).fit(fullFeatures,gt)
+      save_cached(self, key, self.lda)
+    print self.lda
+    return self
+
+  def transform(self, pixels, fullFeatures=None):
+    assert self.lda is not None, "LDAFeatures has not been fit"
+    if fullFeatures is None:
+      fullFeatures = naive_features(pixels)
+    return self.lda.transform(fullFeatures)
 
   def features(self, pixels, gt=None):
     #grab feature stack
     fullFeatures = naive_features(pixels)
-    print fullFeatures.shape
 
-    #if the LDA from ground truth exists already, transform new features
-    if gt==None and self.lda != None:
-      print self.lda
-      return self.lda.transform(fullFeatures)
-    assert gt != None
-
-    #otherwise, train LDA
-    self.lda = LDA(n_components=self.n_comp).fit(fullFeatures,gt)
-    print self.lda
-    return self.lda.transform(fullFeatures)
+    #train LDA if ground truth is given, otherwise transform with the existing one
+    if gt is not None:
+      self.fit(pixels, gt, fullFeatures)
+    return self.transform(pixels, fullFeatures)
 
 class PCAFeatures:
-  def __init__(self, n_comp=3):
+  def __init__(self, n_comp=3, cache_dir=None):
+    self.pca = None
     self.n_comp = n_comp
+    self.cache_dir = cache_dir
 
-  def features(self, pixels):
-    fullFeatures = naive_features(pixels)
-    self.pca = PCA(n_components=self.n_comp).fit(fullFeatures)
+  def fit(self, pixels, gt=None, fullFeatures=None):
+    """ Fits (or loads from cache) the PCA projection, gt is ignored """
+    key = cache_key(self, pixels, fullFeatures=fullFeatures)
+    self.pca = load_cached(self, key)
+    if self.pca is None:
+      if fullFeatures is None:
+        fullFeatures = naive_features(pixels)
+      self.pca = PCA(n_components=self.n_comp).fit(fullFeatures)
+      save_cached(self, key, self.pca)
+    return self
+
+  def transform(self, pixels, fullFeatures=None):
+    assert self.pca is not None, "PCAFeatures has not been fit"
+    if fullFeatures is None:
+      fullFeatures = naive_features(pixels)
     return self.pca.transform(fullFeatures)
 
+  def features(self, pixels, gt=None):
+    #fit on first use (or when ground truth is given), then just project
+    fullFeatures = naive_features(pixels)
+    if gt is not None or getattr(self, "pca", None) is None:
+      self.fit(pixels, gt, fullFeatures)
+    return self.transform(pixels, fullFeatures)
+
+class IncrementalLDA:
+  """ LDA of the naive features fit from streamed chunks.  partial_fit only
+      accumulates per class counts and sums and the total scatter matrix,
+      so memory does not depend on the number of rows.  The projection is
+      solved on the first transform: whiten the within class scatter
+      (dropping its null space, the naive features are collinear), then
+      take the leading directions of the whitened class means.
+  """
+  def __init__(self, n_comp=3, tol=1e-8):
+    self.n_comp = n_comp
+    self.tol = tol
+    self.reset()
+
+  def reset(self):
+    self.counts = None
+    self.sums = None
+    self.scatter = None
+    self.W = None
+
+  def partial_fit(self, pixels, gt, fullFeatures=None):
+    if fullFeatures is None:
+      fullFeatures = naive_features(pixels)
+    F = np.asarray(fullFeatures, dtype=np.float64)
+    gt = np.asarray(gt, dtype=int)
+    nClasses = gt.max() + 1
+    if self.counts is None:
+      self.counts = np.zeros(0)
+      self.sums = np.zeros( (0, F.shape[1]) )
+      self.scatter = np.zeros( (F.shape[1], F.shape[1]) )
+    if nClasses > len(self.counts):
+      grow = nClasses - len(self.counts)
+      self.counts = np.r_[self.counts, np.zeros(grow)]
+      self.sums = np.vstack( (self.sums, np.zeros((grow, F.shape[1]))) )
+
+    self.counts[:nClasses] += np.bincount(gt, minlength=nClasses)
+    for c in np.unique(gt):
+      self.sums[c] += F[gt==c].sum(0)
+    self.scatter += np.dot(F.T, F)
+    self.W = None
+    return self
+
+  def solve(self):
+    present = self.counts > 0
+    counts, sums = self.counts[present], self.sums[present]
+    self.mean = sums.sum(0) / counts.sum()
+    means = sums / counts[:,np.newaxis]
+
+    #within class covariance: total second moment minus the class mean parts
+    Sw = (self.scatter - np.dot(sums.T, means)) / max(counts.sum() - len(counts), 1)
+    evals, evecs = np.linalg.eigh(Sw)
+    keep = evals > self.tol * evals.max()
+    whiten = evecs[:,keep] / np.sqrt(evals[keep])
+
+    #between class scatter in the whitened space
+    centered = np.dot(means - self.mean, whiten) * np.sqrt(counts)[:,np.newaxis]
+    bvals, bvecs = np.linalg.eigh(np.dot(centered.T, centered))
+    nComp = min(self.n_comp, len(counts)-1, bvecs.shape[1])
+    self.W = np.dot(whiten, bvecs[:,::-1][:,:nComp])
+
+  def fit(self, pixels, gt, fullFeatures=None):
+    self.reset()
+    self.partial_fit(pixels, gt, fullFeatures)
+    self.solve()
+    return self
+
+  def transform(self, pixels, fullFeatures=None):
+    assert self.counts is not None, "IncrementalLDA has not been fit"
+    if self.W is None:
+      self.solve()
+    if fullFeatures is None:
+      fullFeatures = naive_features(pixels)
+    return np.dot(fullFeatures - self.mean, self.W)
+
+  def features(self, pixels, gt=None):
+    fullFeatures = naive_features(pixels)
+    if gt is not None:
+      self.fit(pixels, gt, fullFeatures)
+    return self.transform(pixels, fullFeatures)
+
+class ProjectedFeatures:
+  """ Fixed affine projection of the naive features, np.dot(F, W) + b.
+      This is how fitted LDA/PCA reducers come back from model bundles.
+  """
+  def __init__(self, W, b):
+    self.W = W
+    self.b = b
+
+  def fit(self, pixels, gt=None, fullFeatures=None):
+    return self
+
+  def transform(self, pixels, fullFeatures=None):
+    if fullFeatures is None:
+      fullFeatures = naive_features(pixels)
+    return np.dot(fullFeatures, self.W) + self.b
+
+  def features(self, pixels, gt=None):
+    return self.transform(pixels)
+
 class NaiveFeatures:
-  def features(self, pixels):
+  def fit(self, pixels, gt=None, fullFeatures=None):
+    return self
+
+  def transform(self, pixels, fullFeatures=None):
+    if fullFeatures is not None:
+      return fullFeatures
+    return naive_features(pixels)
+
+  def features(self, pixels, gt=None):
     fullFeatures = naive_features(pixels)
     return fullFeatures
 
 
-def naive_features(pixels):
+def cache_key(reducer, pixels, gt=None, fullFeatures=None, blockRows=1<<20):
+  """ sha1 of the reducer type/parameters and the training pixels (and 
+      labels), hashed a block of rows at a time (no full copy of memmaps).
+      Without pixels (fit(None, gt, fullFeatures)) the feature matrix is
+      hashed instead.
+  """
+  h = hashlib.sha1()
+  h.update("%s:%d"%(reducer.__class__.__name__, reducer.n_comp))
+  if pixels is None:
+    assert fullFeatures is not None, "cache_key needs pixels or features"
+    h.update("features")
+    data = fullFeatures
+  else:
+    data = pixels
+  for a in (data, gt):
+    if a is None:
+      continue
+    h.update("%s%s"%(a.dtype.str, a.shape))
+    for r0 in range(0, a.shape[0], blockRows):
+      h.update( np.ascontiguousarray(a[r0:r0+blockRows]).data )
+  return h.hexdigest()
+
+def _cache_file(reducer, key):
+  return os.path.join(reducer.cache_dir, "%s_%s.pkl"%(reducer.__class__.__name__, key))
+
+def load_cached(reducer, key):
+  """ Fitted projection stored under key, or None """
+  if not getattr(reducer, "cache_dir", None):
+    return None
+  fname = _cache_file(reducer, key)
+  if not os.path.exists(fname):
+    return None
+  print "Loading cached projection ", fname
+  return pickle.load(open(fname, 'rb'))
+
+def save_cached(reducer, key, fitted):
+  if not getattr(reducer, "cache_dir", None):
+    return
+  if not os.path.exists(reducer.cache_dir):
+    os.makedirs(reducer.cache_dir)
+  out = open(_cache_file(reducer, key), 'wb')
+  pickle.dump(fitted, out, pickle.HIGHEST_PROTOCOL)
+  out.close()
+
+
+def naive_features(pixels, out=None, blockRows=16384):
   """Stacks a bunch of ratios/differences into a 
-     high dimensional feature vector
+     high dimensional feature vector:
+        pixels (d), pixels/intensity (d), (p_i-p_j)/intensity for i != j
+     All columns are written into one float32 (nPix x d*(d+1)) matrix
+     (out, if given), a block of rows at a time so the working set stays
+     in cache.  Each i<j difference is computed once, j>i is its negation.
   """
   #return pixels as only feature...
   if len(pixels.shape) == 1:
-    return np.column_stack( (pixels,pixels) )
+    out = _feature_out(out, pixels.shape[0], 2)
+    out[:,0] = pixels
+    out[:,1] = pixels
+    return out
 
-  #create sqr differences features for each channel
-  intensity = pixels.sum(1) #total intensity
-  pixelSize = pixels.shape[1]
-  diffs = []
-  for i in range(pixelSize):
-    for j in range(pixelSize):
-      if i==j: continue
-      diff = (pixels[:,i] - pixels[:,j]) / intensity
-      diffs.append(diff)
-  diffs = np.array(diffs).T
+  nPix, pixelSize = pixels.shape
+  out = _feature_out(out, nPix, pixelSize*(pixelSize+1))
+  pairs = _diff_pairs(pixelSize)
+  for r0 in range(0, nPix, blockRows):
+    block = out[r0:r0+blockRows]
+    raw = block[:,:pixelSize]
+    raw[...] = pixels[r0:r0+blockRows]
+    intensity = raw.sum(1)[:,np.newaxis] #total intensity
 
-  #create ratios
-  ratios = []
-  for i in range(pixelSize):
-    ratio = pixels[:,i] / intensity
-    ratios.append(ratio)
-  ratios = np.array(ratios).T
-  return np.column_stack( (pixels, ratios, diffs) )
+    #create ratios
+    np.divide(raw, intensity, out=block[:,pixelSize:2*pixelSize])
 
+    #create differences for each channel pair
+    for i, j, ij, ji in pairs:
+      diff = block[:,ij]
+      np.subtract(raw[:,i], raw[:,j], out=diff)
+      diff /= intensity[:,0]
+      np.negative(diff, out=block[:,ji])
+  return out
 
+def _feature_out(out, nPix, nFeatures):
+  """ Checks (or allocates) the float32 feature output matrix """
+  if out is None:
+    return np.empty( (nPix, nFeatures), dtype=np.float32 )
+  assert out.shape == (nPix, nFeatures), "out must be %dx%d"%(nPix, nFeatures)
+  return out
 
+_pairCache = {}
+def _diff_pairs(pixelSize):
+  """ (i, j, column of i-j, column of j-i) for i<j, columns in the original
+      i,j (i != j) stacking order """
+  if pixelSize not in _pairCache:
+    col = lambda i, j: 2*pixelSize + i*(pixelSize-1) + (j if j < i else j-1)
+    _pairCache[pixelSize] = [ (i, j, col(i,j), col(j,i)) 
+                              for i in range(pixelSize) for j in range(i+1, pixelSize) ]
+  return _pairCache[pixelSize]
@@ -1,17 +1,28 @@
-from scipy.optimize.optimize import fmin_cg, fmin_bfgs, fmin
+from scipy.optimize import minimize
+from scipy.special import expit
 import numpy as np
 from sklearn import datasets
 
 def sigmoid(x):
-    return 1.0 / (1.0 + np.exp(-x))
+    return expit(x)
 
 class LogReg():
     """ A simple logistic regression model with L2 regularization (zero-mean
-    Gaussian priors on parameters). """
+    Gaussian priors on parameters). The first beta is not regularized.
 
-    def __init__(self, alpha=.1, synthetic=False):
+    With batch_size set, fit runs mini-batch SGD over contiguous row blocks
+    instead of BFGS, so x_train can be a memory mapped array that does not
+    fit in RAM. """
+
+    def __init__(self, alpha=.1, synthetic=False, batch_size=None,
+                 n_epochs=5, learning_rate=.5, seed=0):
         # Set L2 regularization strength
         self.alpha = alpha
+        # SGD settings (only used when batch_size is set)
+        self.batch_size = batch_size
+        self.n_epochs = n_epochs
+        self.learning_rate = learning_rate
+        self.seed = seed
 
     def fit(self, x_train, y_train):
         # Set the data.
@@ -23,43 +34,84 @@ class LogReg():
         self.betas = np.zeros(self.x_train.shape[1])
 
         # train the classifier
-        self.train()
+        if self.batch_size:
+            self.train_sgd()
+        else:
+            self.train()
 
     def negative_lik(self, betas):
         return -1 * self.lik(betas)
 
     def lik(self, betas):
         """ Likelihood of the data under the current settings of parameters. """
+        return -1 * self.negative_lik_grad(betas)[0]
+
+    def negative_lik_grad(self, betas, x=None, y=None):
+        """ Negative log likelihood and its gradient, computed together in
+        one vectorized pass (defaults to the training data). """
+        if x is None:
+            x, y = self.x_train, self.y_train
         # l = sum log sigmoid( Y * beta dot X ) - sum alpha/2 * beta^2
-        bDotX = np.sum(betas*self.x_train,1)
-        l = np.sum(np.log(sigmoid(self.y_train * bDotX)))
-        l -= (self.alpha/2.0) * np.sum(self.betas*self.betas)
-        return l
+        yz = y * np.dot(x, betas)
+        nl = np.sum(np.logaddexp(0, -yz))
+        # d/dB_k -l = -sum Y X_k sigmoid(-Y beta dot X) + alpha B_k
+        grad = -np.dot(y * sigmoid(-yz), x)
+        reg = self.alpha * betas
+        reg[0] = 0
+        nl += .5 * np.dot(reg, betas)
+        grad += reg
+        return nl, grad
 
     def train(self):
-        """ Define the gradient and hand it off to a scipy gradient-based
+        """ Hand the fused likelihood/gradient off to a scipy gradient-based
         optimizer. """
-        
-        # Define the derivative of the likelihood with respect to beta_k.
-        # Need to multiply by -1 because we will be minimizing.
-        dB_k = lambda B, k : (k > 0) * self.alpha * B[k] - np.sum([ \
-                                     self.y_train[i] * self.x_train[i, k] * \
-                                     sigmoid(-self.y_train[i] *\
-                                             np.dot(B, self.x_train[i,:])) \
-                                     for i in range(self.n)])
-        
-        # The full gradient is just an array of componentwise derivatives
-        dB = lambda B : np.array([dB_k(B, k) \
-                                  for k in range(self.x_train.shape[1])])
-        
-        # Optimize
-        self.betas = fmin_bfgs(self.negative_lik, self.betas, fprime=dB)
-
+        res = minimize(self.negative_lik_grad, self.betas, jac=True, method="BFGS")
+        self.betas = res.x
+
+    def train_sgd(self):
+        """ Mini-batch SGD over contiguous row blocks, visited in random order """
+        rng = np.random.RandomState(self.seed)
+        starts = np.arange(0, self.n, self.batch_size)
+        self.grad_sq = np.zeros_like(self.betas)
+        for epoch in range(self.n_epochs):
+            for start in rng.permutation(starts):
+                end = start + self.batch_size
+                self.sgd_step(np.asarray(self.x_train[start:end]),
+                              np.asarray(self.y_train[start:end]))
+
+    def partial_fit(self, x, y, n_total=None):
+        """ AdaGrad mini-batches over one chunk of data (y is +1/-1), in row
+        order, so a data set that does not fit in memory can be streamed
+        through in pieces (shuffle the chunks).  Continues from a previous
+        fit/partial_fit.  The regularizer is scaled by n_total, the size of
+        the whole data set (default: the number of rows seen so far). """
+        if not hasattr(self, "betas"):
+            self.betas = np.zeros(x.shape[1])
+        if not hasattr(self, "grad_sq"):
+            self.grad_sq = np.zeros_like(self.betas)
+        self.n_seen = getattr(self, "n_seen", 0) + x.shape[0]
+        self.n = n_total or self.n_seen
+        step = self.batch_size or x.shape[0]
+        for start in range(0, x.shape[0], step):
+            self.sgd_step(np.asarray(x[start:start+step]),
+                          np.asarray(y[start:start+step]))
+        return self
+
+    def sgd_step(self, x, y):
+        """ One AdaGrad step on the mean negative log likelihood of a batch,
+        with the regularizer scaled to the batch's share of the data. """
+        yz = y * np.dot(x, self.betas)
+        grad = -np.dot(y * sigmoid(-yz), x) / x.shape[0]
+        reg = (self.alpha / self.n) * self.betas
+        reg[0] = 0
+        grad += reg
+        self.grad_sq += grad * grad
+        self.betas -= self.learning_rate * grad / np.sqrt(self.grad_sq + 1e-8)
 
     def predict_proba(self, x_test):
         """ computes probabilities given features x_test
         """
-        p_y = sigmoid( np.sum(self.betas*x_test, 1) )
+        p_y = sigmoid( np.dot(x_test, self.betas) )
         return p_y
 
     def predict(self, x_test):
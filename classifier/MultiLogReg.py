@@ -2,41 +2,87 @@ import numpy as np
 import pylab as pl
 from LogReg import LogReg
 from sklearn import datasets
+from parallel import create_pool, run_pool, get_shared, n_workers
+
+def _fit_worker(args):
+    c, kwargs = args
+    #create two class training set (+1/-1, independent of y_train dtype)
+    y_c = np.where(get_shared("y")==c, 1.0, -1.0)
+    model = LogReg(**kwargs)
+    model.fit(get_shared("x"), y_c)
+    #don't ship the training data back to the parent
+    del model.x_train, model.y_train
+    return model
+
+def _proba_worker(idx):
+    p_y = get_shared("p_y")
+    p_y[:,idx] = get_shared("classifiers")[idx].predict_proba(get_shared("x"))
 
 class MultiLogReg():
     """ Multi class logistic regression that trains independent, binary 
-        classifiers for each class 
+        classifiers for each class.  With n_jobs > 1 (-1 for all cpus)
+        the per-class fits and predictions run in a process pool that
+        shares the feature matrix through shared memory.
     """
-    def __init__(self):
-        pass
+    def __init__(self, alpha=.1, batch_size=None, n_epochs=5, n_jobs=1):
+        # passed on to each binary LogReg (batch_size enables SGD)
+        self.alpha = alpha
+        self.batch_size = batch_size
+        self.n_epochs = n_epochs
+        self.n_jobs = n_jobs
 
     def fit(self, x_train, y_train):
         """ Assumes classes are encoded starting at 0 """
         # Set the data.
         self.n = y_train.shape[0]
         self.classes = set(y_train)
+        kwargs = { "alpha": self.alpha, "batch_size": self.batch_size,
+                   "n_epochs": self.n_epochs }
 
         #train each classifier
+        if n_workers(getattr(self, "n_jobs", 1)) > 1:
+          pool, views = create_pool(self.n_jobs, {"x": x_train, "y": y_train})
+          self.classifiers = run_pool(pool, _fit_worker,
+                                      [(c, kwargs) for c in self.classes])
+          return
         self.classifiers = []
         for c in self.classes:
-          #create two class training set
-          y_c = np.copy(y_train)
-          y_c[y_c!=c] = -1
-          y_c[y_c==c] = 1
+          #create two class training set (+1/-1, independent of y_train dtype)
+          y_c = np.where(y_train==c, 1.0, -1.0)
           #train model
-          model = LogReg()
+          model = LogReg(**kwargs)
           model.fit(x_train, y_c)
           self.classifiers.append(model)
 
+    def partial_fit(self, x, y, classes=None, n_total=None):
+        """ Streams one chunk through every binary model (see
+        LogReg.partial_fit).  classes (all class ids) must be given on the
+        first call unless the first chunk contains every class. """
+        if not hasattr(self, "classifiers"):
+          self.classes = set(classes if classes is not None else y)
+          self.classifiers = [ LogReg(alpha=self.alpha, batch_size=self.batch_size,
+                                      n_epochs=self.n_epochs) for c in self.classes ]
+        for c, model in zip(self.classes, self.classifiers):
+          model.partial_fit(x, np.where(y==c, 1.0, -1.0), n_total)
+        self.n = self.classifiers[0].n
+        return self
+
     def predict_proba(self, x_test):
         """ computes probabilities given features x_test
         """
         nTest = x_test.shape[0]
         p_y = np.zeros( (nTest, len(self.classes)+1) )
-        for idx in range(len(self.classes)):
-          model = self.classifiers[idx]
-          positiveProb = np.array(model.predict_proba(x_test))
-          p_y[:,idx] = positiveProb[:]
+        if n_workers(getattr(self, "n_jobs", 1)) > 1:
+          #workers write their class column straight into shared p_y
+          pool, views = create_pool(self.n_jobs, {"x": x_test, "p_y": p_y},
+                                    classifiers=self.classifiers)
+          run_pool(pool, _proba_worker, range(len(self.classes)))
+          p_y = np.array(views["p_y"])
+        else:
+          for idx in range(len(self.classes)):
+            model = self.classifiers[idx]
+            positiveProb = np.array(model.predict_proba(x_test))
+            p_y[:,idx] = positiveProb[:]
         
         #be sure to calculate the null category
         p_y[:,-1] = np.mean(1.0-p_y[:,0:-1],1)
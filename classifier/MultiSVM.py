@@ -1,13 +1,30 @@
 import numpy as np
 import pylab as pl
 from sklearn import svm, datasets
+from parallel import create_pool, run_pool, get_shared, n_workers
+
+def fit_class(x_train, y_train, c, gamma=.7):
+    """ Trains the binary (class c vs rest) SVM """
+    #create two class training set (class c is 0, rest is 1)
+    y_c = np.where(y_train==c, 0, 1)
+    return svm.SVC(kernel='rbf', gamma=gamma, probability=True).fit(x_train, y_c)
+
+def _fit_worker(c):
+    return fit_class(get_shared("x"), get_shared("y"), c, get_shared("gamma"))
+
+def _proba_worker(idx):
+    p_y = get_shared("p_y")
+    p_y[:,idx] = get_shared("classifiers")[idx].predict_proba(get_shared("x"))[:,0]
 
 class MultiSVM():
     """ Multi class SVM that trains independent, binary 
-        classifiers for each class 
+        classifiers for each class.  With n_jobs > 1 (-1 for all cpus)
+        the per-class fits and predictions run in a process pool that
+        shares the feature matrix through shared memory.
     """
-    def __init__(self):
-        pass
+    def __init__(self, n_jobs=1, gamma=.7):
+        self.n_jobs = n_jobs
+        self.gamma = gamma
 
     def fit(self, x_train, y_train):
         # Set the data.
@@ -15,16 +32,14 @@ class MultiSVM():
         self.classes = set(y_train)
 
         #train each classifier
+        gamma = getattr(self, "gamma", .7)
+        if n_workers(getattr(self, "n_jobs", 1)) > 1:
+          pool, views = create_pool(self.n_jobs, {"x": x_train, "y": y_train}, gamma=gamma)
+          self.classifiers = run_pool(pool, _fit_worker, list(self.classes))
+          return
         self.classifiers = []
         for c in self.classes:
-          #create two class training set
-          y_c = np.copy(y_train)
-          y_c[y_c!=c] = -1
-          y_c[y_c==c] = 0
-          y_c[y_c==-1] = 1
-          #train model
-          model = svm.SVC(kernel='rbf', gamma=.7, probability=True).fit(x_train, y_c)
-          self.classifiers.append(model)
+          self.classifiers.append( fit_class(x_train, y_train, c, gamma) )
 
     def predict_proba(self, x_test):
         """ computes probabilities given features x_test/model trained.
@@ -32,10 +47,17 @@ class MultiSVM():
         """
         nTest = x_test.shape[0]
         p_y = np.zeros( (nTest, len(self.classes)+1) )
-        for idx in range(len(self.classes)):
-          model = self.classifiers[idx]
-          positiveProb = np.array(model.predict_proba(x_test))
-          p_y[:,idx] = positiveProb[:,0]
+        if n_workers(getattr(self, "n_jobs", 1)) > 1:
+          #workers write their class column straight into shared p_y
+          pool, views = create_pool(self.n_jobs, {"x": x_test, "p_y": p_y},
+                                    classifiers=self.classifiers)
+          run_pool(pool, _proba_worker, range(len(self.classes)))
+          p_y = np.array(views["p_y"])
+        else:
+          for idx in range(len(self.classes)):
+            model = self.classifiers[idx]
+            positiveProb = np.array(model.predict_proba(x_test))
+            p_y[:,idx] = positiveProb[:,0]
         
         #be sure to estimate the null category
         p_y[:,-1] = np.mean(1.0-p_y[:,0:-1], 1)
@@ -0,0 +1,171 @@
+from scipy.optimize import minimize
+import numpy as np
+import pylab as pl
+from sklearn import datasets
+
+def softmax(z):
+    """ Row-wise softmax, computed in place on z """
+    z -= z.max(1)[:, np.newaxis]
+    np.exp(z, z)
+    z /= z.sum(1)[:, np.newaxis]
+    return z
+
+class SoftmaxReg():
+    """ Multinomial (softmax) logistic regression with L2 regularization on
+        the weights (the per-class intercepts are not regularized).  All
+        classes are trained jointly in one optimization over the shared
+        design matrix and predicted with a single matrix multiply.
+        Same fit/predict_proba interface as MultiLogReg.
+    """
+    def __init__(self, alpha=.1, batch_size=None, n_epochs=5,
+                 learning_rate=.5, seed=0):
+        # Set L2 regularization strength
+        self.alpha = alpha
+        # SGD settings (only used when batch_size is set)
+        self.batch_size = batch_size
+        self.n_epochs = n_epochs
+        self.learning_rate = learning_rate
+        self.seed = seed
+
+    def fit(self, x_train, y_train):
+        """ Assumes classes are encoded starting at 0 """
+        # Set the data.
+        self.x_train = x_train
+        self.y_train = np.asarray(y_train, dtype=int)
+        self.n = y_train.shape[0]
+        self.classes = set(y_train)
+        self.n_classes = self.y_train.max() + 1
+
+        # weights (features x classes) and intercepts, packed for the optimizer
+        self.W = np.zeros((x_train.shape[1], self.n_classes))
+        self.b = np.zeros(self.n_classes)
+
+        # train the classifier
+        if self.batch_size:
+            self.train_sgd()
+        else:
+            self.train()
+
+    def pack(self, W, b):
+        return np.concatenate((W.ravel(), b))
+
+    def unpack(self, theta):
+        nW = self.W.size
+        return theta[:nW].reshape(self.W.shape), theta[nW:]
+
+    def data_grad(self, W, b, x, y):
+        """ Negative log likelihood of (x, y) and its gradient w.r.t. W and b
+        (no regularization) """
+        z = np.dot(x, W) + b
+        rows = np.arange(x.shape[0])
+        zmax = z.max(1)
+        lse = zmax + np.log(np.exp(z - zmax[:, np.newaxis]).sum(1))
+        nl = np.sum(lse - z[rows, y])
+        # d/dz -l = softmax(z) - onehot(y)
+        p = softmax(z)
+        p[rows, y] -= 1.0
+        return nl, np.dot(x.T, p), p.sum(0)
+
+    def negative_lik_grad(self, theta):
+        """ Regularized negative log likelihood and its (packed) gradient """
+        W, b = self.unpack(theta)
+        nl, gW, gb = self.data_grad(W, b, self.x_train, self.y_train)
+        nl += (self.alpha/2.0) * np.sum(W*W)
+        gW += self.alpha * W
+        return nl, self.pack(gW, gb)
+
+    def train(self):
+        """ Hand the fused likelihood/gradient off to scipy's BFGS """
+        res = minimize(self.negative_lik_grad, self.pack(self.W, self.b),
+                       jac=True, method="BFGS")
+        self.W, self.b = self.unpack(res.x)
+
+    def train_sgd(self):
+        """ Mini-batch SGD over contiguous row blocks, visited in random order """
+        rng = np.random.RandomState(self.seed)
+        starts = np.arange(0, self.n, self.batch_size)
+        self.grad_sq_W = np.zeros_like(self.W)
+        self.grad_sq_b = np.zeros_like(self.b)
+        for epoch in range(self.n_epochs):
+            for start in rng.permutation(starts):
+                end = start + self.batch_size
+                self.sgd_step(np.asarray(self.x_train[start:end]),
+                              self.y_train[start:end])
+
+    def partial_fit(self, x, y, classes=None, n_total=None):
+        """ AdaGrad mini-batches over one chunk of data, in row order, so a
+        data set that does not fit in memory can be streamed through in
+        pieces (shuffle the chunks).  classes (all class ids) must be given
+        on the first call unless the first chunk contains every class.  The
+        regularizer is scaled by n_total (default: rows seen so far). """
+        if not hasattr(self, "W"):
+            self.classes = set(classes if classes is not None else y)
+            self.n_classes = int(max(self.classes)) + 1
+            self.W = np.zeros((x.shape[1], self.n_classes))
+            self.b = np.zeros(self.n_classes)
+        if not hasattr(self, "grad_sq_W"):
+            self.grad_sq_W = np.zeros_like(self.W)
+            self.grad_sq_b = np.zeros_like(self.b)
+        self.n_seen = getattr(self, "n_seen", 0) + x.shape[0]
+        self.n = n_total or self.n_seen
+        step = self.batch_size or x.shape[0]
+        for start in range(0, x.shape[0], step):
+            self.sgd_step(np.asarray(x[start:start+step]),
+                          np.asarray(y[start:start+step], dtype=int))
+        return self
+
+    def sgd_step(self, x, y):
+        """ One AdaGrad step on the mean negative log likelihood of a batch,
+        with the regularizer scaled to the batch's share of the data. """
+        nl, gW, gb = self.data_grad(self.W, self.b, x, y)
+        gW /= x.shape[0]
+        gb /= x.shape[0]
+        gW += (self.alpha / self.n) * self.W
+        self.grad_sq_W += gW * gW
+        self.grad_sq_b += gb * gb
+        self.W -= self.learning_rate * gW / np.sqrt(self.grad_sq_W + 1e-8)
+        self.b -= self.learning_rate * gb / np.sqrt(self.grad_sq_b + 1e-8)
+
+    def predict_proba(self, x_test):
+        """ computes probabilities given features x_test
+        """
+        nTest = x_test.shape[0]
+        p_y = np.empty( (nTest, self.n_classes+1) )
+        p_y[:,:-1] = softmax(np.dot(x_test, self.W) + self.b)
+
+        #null category: probability that no class is confident
+        p_y[:,-1] = 1.0 - p_y[:,:-1].max(1)
+        return p_y
+
+    def predict(self, x_test):
+        probas = self.predict_proba(x_test)
+        return probas.argmax(1)
+
+
+# Test on synthetic data
+if __name__ == "__main__":
+
+    X, y = datasets.make_blobs()
+
+    #train softmax model
+    clf = SoftmaxReg()
+    clf.fit(X,y)
+
+    # Plot the decision boundary. For that, we will asign a color to each
+    # point in the mesh [x_min, m_max]x[y_min, y_max].
+    h = .05
+    x_min, x_max = X[:, 0].min() - 1, X[:, 0].max() + 1
+    y_min, y_max = X[:, 1].min() - 1, X[:, 1].max() + 1
+    xx, yy = np.meshgrid(np.arange(x_min, x_max, h), np.arange(y_min, y_max, h))
+    Z = clf.predict(np.c_[xx.ravel(), yy.ravel()])
+
+    # Put the result into a color plot
+    Z = Z.reshape(xx.shape)
+    pl.set_cmap(pl.cm.Paired)
+    pl.pcolormesh(xx, yy, Z)
+
+    # Plot also the training points
+    pl.scatter(X[:, 0], X[:, 1], c=y)
+    pl.title('Softmax Regression')
+    pl.axis('tight')
+    pl.show()
@@ -0,0 +1,186 @@
+import numpy as np
+import sys, os, time, json, shutil, tempfile, platform, resource, subprocess
+import multiprocessing as mp
+import sklearn
+from optparse import OptionParser
+from utils import RGBIDataset, classify_pixels
+from Features import naive_features
+from models import MODEL_TYPES, build_model
+
+"""
+Classifier benchmarks.  For synthetic RGBI flat files of several sizes
+(and the bundled data/train_small.txt, data/test_small.txt) times
+
+  load      RGBIDataset parse of the train file
+  features  naive_features of the training pixels
+  fit       reducer + model fit, per model type
+  predict   predict_proba on the test pixels, per model type
+  classify  classify_pixels of a synthetic EO/IR image pair, per model type
+
+taking the best of -r repeats.  Every (data set, model type) case runs in
+its own child process so its peak resident memory (ru_maxrss) is its own.
+Results go to a JSON file; -c prints the ratio to an earlier run.
+
+% python bench.py -s 2000,20000 -m isvm_lda,ilogreg,softmax_lda -o bench.json
+"""
+
+BUNDLED = [ ("small", "data/train_small.txt", "data/test_small.txt") ]
+SYNTHETIC_CLASSES = [ "road", "trees", "water", "grass" ]
+
+############################################
+# synthetic data
+############################################
+def synthetic_pixels(n, seed=0, nClasses=4):
+  """ n 8 bit (IR,R,G,B) pixels/255 from per class gaussians, and their labels """
+  rng = np.random.RandomState(seed)
+  means = np.random.RandomState(1234).uniform(40, 215, size=(nClasses, 4))
+  Y = rng.randint(0, nClasses, n)
+  pixels = np.clip( np.round(means[Y] + rng.normal(scale=25, size=(n, 4))), 0, 255 ) / 255.0
+  return pixels, Y
+
+def write_flat_file(fname, n, seed=0):
+  """ Flat file in the boxm2 classify format (class name then IR R G B) """
+  pixels, Y = synthetic_pixels(n, seed, len(SYNTHETIC_CLASSES))
+  out = open(fname, 'w')
+  for y, row in zip(Y, pixels):
+    out.write("%s  %s\n"%(SYNTHETIC_CLASSES[y], " ".join("%g"%v for v in row)))
+  out.close()
+
+def synthetic_image(rows, cols, seed=0):
+  """ Synthetic 8 bit EO (RGB) and IR images """
+  pixels, Y = synthetic_pixels(rows*cols, seed, len(SYNTHETIC_CLASSES))
+  pixels = np.round(pixels*255).astype(np.uint8)
+  return pixels[:,1:].reshape(rows, cols, 3), pixels[:,0].reshape(rows, cols)
+
+############################################
+# timing
+############################################
+def best_time(func, repeats):
+  """ (min wall seconds over repeats, last result) """
+  best, result = None, None
+  for r in range(repeats):
+    start = time.time()
+    result = func()
+    t = time.time() - start
+    best = t if best is None else min(best, t)
+  return best, result
+
+def peak_mb():
+  """ Peak resident memory of this process (ru_maxrss is kB on linux) """
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def run_case(case):
+  """ Times every stage of one (data set, model type) case """
+  name, trainFile, testFile, modelType, repeats, imageSize = case
+  baseMB = peak_mb()
+  result = { "dataset" : name, "model" : modelType }
+
+  result["load"], train = best_time(lambda: RGBIDataset(trainFile), repeats)
+  test = RGBIDataset(testFile)
+  result["n_train"], result["n_test"] = len(train.target), len(test.target)
+  result["features"], F = best_time(lambda: naive_features(train.pixels), repeats)
+
+  def fit():
+    reducer, model = build_model(modelType)
+    reducer.fit(train.pixels, train.target, F)
+    model.fit(reducer.transform(train.pixels, F), train.target)
+    return reducer, model
+  result["fit"], (reducer, model) = best_time(fit, repeats)
+  result["predict"], probs = best_time(
+    lambda: model.predict_proba(reducer.transform(test.pixels)), repeats)
+  result["predict_pixels_per_second"] = result["n_test"] / max(result["predict"], 1e-9)
+
+  eo, ir = synthetic_image(imageSize, imageSize)
+  result["classify"], img = best_time(lambda: classify_pixels(eo, ir, reducer, model), repeats)
+  result["classify_pixels_per_second"] = imageSize*imageSize / max(result["classify"], 1e-9)
+
+  result["peak_mb"] = peak_mb()
+  result["peak_delta_mb"] = result["peak_mb"] - baseMB
+  return result
+
+def run_isolated(case):
+  """ run_case in a fresh child process (so peak memory is per case) """
+  pool = mp.Pool(1, maxtasksperchild=1)
+  try:
+    return pool.apply(run_case, (case,))
+  finally:
+    pool.close()
+    pool.join()
+
+def environment():
+  try:
+    commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT).strip()
+  except (OSError, subprocess.CalledProcessError):
+    commit = None
+  return { "time"    : time.strftime("%Y-%m-%d %H:%M:%S"),
+           "host"    : platform.node(),
+           "machine" : platform.machine(),
+           "cpus"    : mp.cpu_count(),
+           "python"  : platform.python_version(),
+           "numpy"   : np.__version__,
+           "sklearn" : sklearn.__version__,
+           "commit"  : commit }
+
+def compare(results, previous):
+  """ Prints time ratios (current / previous) of matching cases """
+  old = dict( ((r["dataset"], r["model"]), r) for r in previous["results"] )
+  print "%-14s %-12s %8s %8s %8s %8s %8s"%("dataset", "model", "load", "features", "fit", "predict", "classify")
+  for r in results:
+    o = old.get( (r["dataset"], r["model"]) )
+    if o is None:
+      continue
+    ratios = [ r[k] / max(o[k], 1e-9) for k in ("load", "features", "fit", "predict", "classify") ]
+    print "%-14s %-12s"%(r["dataset"], r["model"]) + "".join(" %7.2fx"%v for v in ratios)
+
+if __name__ == "__main__":
+  # handle inputs
+  parser = OptionParser()
+  parser.add_option("-s", "--sizes", action="store", type="string", dest="sizes", default="2000,20000", help="Comma separated synthetic training set sizes (test sets are the same size)")
+  parser.add_option("-m", "--modelTypes", action="store", type="string", dest="modelTypes", default="isvm_lda,ilogreg,ilogreg_lda,softmax_lda,rffsvm_lda", help="Comma separated model types")
+  parser.add_option("-r", "--repeats", action="store", type="int", dest="repeats", default=3, help="Time each stage this many times, keep the best")
+  parser.add_option("-i", "--imageSize", action="store", type="int", dest="imageSize", default=512, help="Side of the synthetic image classified by classify_pixels")
+  parser.add_option("-n", "--noBundled", action="store_true", dest="noBundled", default=False, help="Skip the bundled data/*_small.txt files")
+  parser.add_option("-c", "--compare", action="store", type="string", dest="compare", default=None, help="Earlier bench JSON to compare against")
+  parser.add_option("-o", "--out", action="store", type="string", dest="out", default="bench.json", help="Output JSON file")
+  (options, args) = parser.parse_args()
+  print options
+
+  modelTypes = [ m for m in options.modelTypes.split(",") if m ]
+  for modelType in modelTypes:
+    if modelType not in MODEL_TYPES:
+      print "Unknown model type %s, choose from %s"%(modelType, ", ".join(MODEL_TYPES))
+      sys.exit(-1)
+
+  #data sets: synthetic flat files (fixed seeds) and the bundled ones
+  tmpDir = tempfile.mkdtemp(prefix="cvg_bench_")
+  datasets = []
+  for n in [ int(s) for s in options.sizes.split(",") if s ]:
+    trainFile = os.path.join(tmpDir, "train_%d.txt"%n)
+    testFile = os.path.join(tmpDir, "test_%d.txt"%n)
+    write_flat_file(trainFile, n, seed=0)
+    write_flat_file(testFile, n, seed=1)
+    datasets.append( ("synthetic_%d"%n, trainFile, testFile) )
+  if not options.noBundled:
+    here = os.path.dirname(os.path.abspath(__file__))
+    datasets += [ (name, os.path.join(here, tr), os.path.join(here, te)) for name, tr, te in BUNDLED
+                  if os.path.exists(os.path.join(here, tr)) ]
+
+  results = []
+  try:
+    for name, trainFile, testFile in datasets:
+      for modelType in modelTypes:
+        r = run_isolated( (name, trainFile, testFile, modelType, options.repeats, options.imageSize) )
+        print "%-14s %-12s load %.3fs features %.3fs fit %.3fs predict %.3fs classify %.3fs peak %.0fMB"%(
+          name, modelType, r["load"], r["features"], r["fit"], r["predict"], r["classify"], r["peak_mb"])
+        results.append(r)
+  finally:
+    shutil.rmtree(tmpDir)
+
+  report = { "environment" : environment(),
+             "settings"    : { "repeats" : options.repeats, "imageSize" : options.imageSize },
+             "results"     : results }
+  json.dump(report, open(options.out, 'w'), indent=2)
+  print "Wrote", options.out
+
+  if options.compare:
+    compare(results, json.load(open(options.compare)))
@@ -0,0 +1,288 @@
+import numpy as np
+import os, json, pickle
+from Features import LDAFeatures, PCAFeatures, NaiveFeatures, ProjectedFeatures, naive_features
+from LogReg import LogReg
+from MultiLogReg import MultiLogReg
+from MultiSVM import MultiSVM
+from SoftmaxReg import SoftmaxReg
+from ApproxSVM import ApproxSVM
+
+"""
+Versioned model bundles.  A bundle is a directory with a manifest.json
+(model/reducer kinds and parameters, pixel type) and one .npy file per 
+array (weights, support vectors, projection matrices).  Arrays are opened
+memory mapped, so loading is near instant and processes running the same
+model share its pages.  Anything without an array encoding is stored as a
+pickle inside the bundle.
+
+  save_bundle(dirName, model, reducer, pixelType)
+  load_model(fname) -> (model, reducer, pixelType)  (bundle or old pickle)
+"""
+
+BUNDLE_FORMAT  = "cvg-classifier-bundle"
+BUNDLE_VERSION = 1
+MANIFEST       = "manifest.json"
+
+#number of pixel channels for each pixel type
+PIXEL_DIMS = { "all" : 4, "EO" : 3, "IR" : 1 }
+
+############################################
+# saving
+############################################
+def save_bundle(dirName, model, reducer, pixelType):
+  """ Writes model, reducer and pixel type as a bundle directory """
+  if not os.path.exists(dirName):
+    os.makedirs(dirName)
+  manifest = { "format"    : BUNDLE_FORMAT,
+               "version"   : BUNDLE_VERSION,
+               "pixelType" : pixelType,
+               "model"     : _save_part(dirName, "model", model, encode_model(model)),
+               "reducer"   : _save_part(dirName, "reducer", reducer, encode_reducer(reducer, pixelType)) }
+  json.dump(manifest, open(os.path.join(dirName, MANIFEST), 'w'), indent=2)
+  return manifest
+
+def _save_part(dirName, prefix, obj, encoded):
+  """ Writes encoded arrays (or a pickle fallback), returns manifest entry """
+  if encoded is None:
+    fname = prefix + ".pkl"
+    out = open(os.path.join(dirName, fname), 'wb')
+    pickle.dump(obj, out, pickle.HIGHEST_PROTOCOL)
+    out.close()
+    return { "kind" : "pickle", "file" : fname }
+  kind, params, arrays = encoded
+  files = {}
+  for name, a in arrays.iteritems():
+    files[name] = "%s_%s.npy"%(prefix, name)
+    np.save(os.path.join(dirName, files[name]), np.ascontiguousarray(a))
+  return { "kind" : kind, "params" : params, "arrays" : files }
+
+def encode_model(model):
+  """ (kind, params, arrays) for models with an array encoding, else None """
+  if isinstance(model, SoftmaxReg):
+    return "softmax", { "alpha" : model.alpha, "classes" : _classes(model) }, \
+           { "W" : model.W, "b" : model.b }
+  if isinstance(model, MultiLogReg):
+    betas = np.array([ m.betas for m in model.classifiers ])
+    return "multilogreg", { "alpha" : model.alpha, "classes" : _classes(model) }, \
+           { "betas" : betas }
+  if isinstance(model, MultiSVM):
+    return _encode_multisvm(model)
+  if isinstance(model, ApproxSVM):
+    params = { "method" : model.method, "gamma" : model.gamma,
+               "alpha" : model.alpha, "classes" : _classes(model) }
+    return "approxsvm", params, { "basis" : model.basis, "offset" : model.offset,
+                                  "coef" : model.coef, "intercept" : model.intercept }
+  return None
+
+def _encode_multisvm(model):
+  """ Per class support vectors/coefficients concatenated, with offsets """
+  svs, coefs, offsets = [], [], [0]
+  intercept, probA, probB, gamma = [], [], [], []
+  for m in model.classifiers:
+    if m.kernel != "rbf" or len(m.classes_) != 2:
+      return None
+    svs.append(m.support_vectors_)
+    coefs.append(m.dual_coef_[0])
+    offsets.append(offsets[-1] + len(coefs[-1]))
+    intercept.append(m.intercept_[0])
+    probA.append(m.probA_[0])
+    probB.append(m.probB_[0])
+    gamma.append(getattr(m, "_gamma", m.gamma))
+  arrays = { "support_vectors" : np.vstack(svs),
+             "dual_coef"       : np.concatenate(coefs),
+             "offsets"         : np.array(offsets),
+             "intercept"       : np.array(intercept),
+             "probA"           : np.array(probA),
+             "probB"           : np.array(probB),
+             "gamma"           : np.array(gamma) }
+  return "multisvm", { "classes" : _classes(model) }, arrays
+
+def _classes(model):
+  return sorted( float(c) for c in model.classes )
+
+def encode_reducer(reducer, pixelType):
+  """ Naive features need nothing; any reducer whose projection of the naive
+      features is affine (LDA, PCA) is stored as W, b recovered by probing it
+      with the unit vectors (and checked on random features).
+  """
+  if isinstance(reducer, NaiveFeatures):
+    return "naive", {}, {}
+  if not hasattr(reducer, "transform"):
+    return None
+  dims = PIXEL_DIMS[pixelType]
+  nFeatures = 2 if dims == 1 else dims*(dims+1)
+  probe = np.vstack( (np.zeros(nFeatures), np.eye(nFeatures)) )
+  T = np.asarray(reducer.transform(None, probe), dtype=np.float64)
+  b = T[0]
+  W = T[1:] - b
+
+  #verify the affine fit
+  test = np.random.RandomState(0).rand(64, nFeatures)
+  if not np.allclose(np.dot(test, W) + b, reducer.transform(None, test), rtol=1e-5, atol=1e-6):
+    return None
+  return "affine", { "source" : reducer.__class__.__name__ }, { "W" : W, "b" : b }
+
+############################################
+# loading
+############################################
+class ModelBundle(object):
+  """ Lazy bundle reader: only the manifest is read up front, model and
+      reducer are built (from memory mapped arrays) on first access """
+  def __init__(self, dirName, mmap=True):
+    self.dirName = dirName
+    self.mmapMode = 'r' if mmap else None
+    self.manifest = json.load(open(os.path.join(dirName, MANIFEST), 'r'))
+    if self.manifest.get("format") != BUNDLE_FORMAT:
+      raise ValueError("%s is not a model bundle"%dirName)
+    if self.manifest["version"] > BUNDLE_VERSION:
+      raise ValueError("Bundle version %d is newer than supported (%d)"%(self.manifest["version"], BUNDLE_VERSION))
+    self.pixelType = str(self.manifest["pixelType"])
+    self._model = None
+    self._reducer = None
+
+  @property
+  def model(self):
+    if self._model is None:
+      self._model = self._load_part(self.manifest["model"], decode_model)
+    return self._model
+
+  @property
+  def reducer(self):
+    if self._reducer is None:
+      self._reducer = self._load_part(self.manifest["reducer"], decode_reducer)
+    return self._reducer
+
+  def _load_part(self, entry, decode):
+    if entry["kind"] == "pickle":
+      return pickle.load(open(os.path.join(self.dirName, entry["file"]), 'rb'))
+    arrays = dict( (name, np.load(os.path.join(self.dirName, f), mmap_mode=self.mmapMode))
+                   for name, f in entry["arrays"].iteritems() )
+    return decode(str(entry["kind"]), entry["params"], arrays)
+
+def decode_model(kind, params, arrays):
+  classes = set(params["classes"])
+  if kind == "softmax":
+    model = SoftmaxReg(alpha=params["alpha"])
+    model.W, model.b = arrays["W"], arrays["b"]
+    model.classes = classes
+    model.n_classes = len(model.b)
+    return model
+  if kind == "multilogreg":
+    model = MultiLogReg(alpha=params["alpha"])
+    model.classes = classes
+    model.classifiers = []
+    for betas in arrays["betas"]:
+      lr = LogReg(alpha=params["alpha"])
+      lr.betas = betas
+      model.classifiers.append(lr)
+    return model
+  if kind == "multisvm":
+    model = MultiSVM()
+    model.classes = classes
+    off = arrays["offsets"]
+    model.classifiers = [ BinaryRBFSVC(arrays["support_vectors"][off[i]:off[i+1]],
+                                       arrays["dual_coef"][off[i]:off[i+1]],
+                                       arrays["intercept"][i], arrays["probA"][i],
+                                       arrays["probB"][i], arrays["gamma"][i])
+                          for i in range(len(off)-1) ]
+    return model
+  if kind == "approxsvm":
+    model = ApproxSVM(method=str(params["method"]), gamma=params["gamma"], alpha=params["alpha"])
+    model.classes = classes
+    model.basis, model.offset = arrays["basis"], arrays["offset"]
+    model.coef, model.intercept = arrays["coef"], arrays["intercept"]
+    model.n_components = model.basis.shape[1]
+    model.n_classes = len(model.intercept)
+    return model
+  raise ValueError("Unknown model kind %s"%kind)
+
+def decode_reducer(kind, params, arrays):
+  if kind == "naive":
+    return NaiveFeatures()
+  if kind == "affine":
+    return ProjectedFeatures(arrays["W"], arrays["b"])
+  raise ValueError("Unknown reducer kind %s"%kind)
+
+def load_bundle(dirName, mmap=True):
+  """ (model, reducer, pixelType) from a bundle directory """
+  b = ModelBundle(dirName, mmap)
+  return b.model, b.reducer, b.pixelType
+
+def load_model(fname):
+  """ (model, reducer, pixelType) from a bundle or an old chained pickle file """
+  if os.path.isdir(fname):
+    return load_bundle(fname)
+  inFile = open(fname, 'rb')
+  model = pickle.load(inFile)
+  reducer = pickle.load(inFile)
+  try:
+    pixelType = pickle.load(inFile)
+  except EOFError:
+    pixelType = "all"
+  inFile.close()
+  return model, reducer, pixelType
+
+############################################
+# array based binary RBF SVM (MultiSVM classifiers in bundles)
+############################################
+class BinaryRBFSVC:
+  """ Probability output of a two class libsvm RBF SVC from its arrays.
+      predict_proba columns follow sklearn (classes 0, 1). 
+  """
+  def __init__(self, supportVectors, dualCoef, intercept, probA, probB, gamma, blockRows=4096):
+    self.sv = supportVectors
+    self.coef = dualCoef
+    self.intercept = intercept
+    self.probA = probA
+    self.probB = probB
+    self.gamma = gamma
+    self.blockRows = blockRows
+    self.svNorm = (np.asarray(supportVectors)**2).sum(1)
+
+  def decision_function(self, x):
+    """ sum_i coef_i exp(-gamma |x - sv_i|^2) + intercept, a block of rows at a time """
+    dec = np.empty(x.shape[0])
+    for r0 in range(0, x.shape[0], self.blockRows):
+      xb = np.asarray(x[r0:r0+self.blockRows], dtype=np.float64)
+      d2 = np.dot(xb, self.sv.T)
+      d2 *= -2.0
+      d2 += (xb**2).sum(1)[:,np.newaxis]
+      d2 += self.svNorm
+      np.maximum(d2, 0, d2)
+      d2 *= -self.gamma
+      np.exp(d2, d2)
+      dec[r0:r0+self.blockRows] = np.dot(d2, self.coef) + self.intercept
+    return dec
+
+  def predict_proba(self, x):
+    #libsvm: platt sigmoid on its (sign flipped) decision value, clamped
+    fApB = -self.probA * self.decision_function(x) + self.probB
+    r = 1.0 / (1.0 + np.exp(fApB))
+    r = np.clip(r, 1e-7, 1-1e-7)
+    p0 = _libsvm_two_class_coupling(r)
+    return np.column_stack( (p0, 1.0-p0) )
+
+def _libsvm_two_class_coupling(r, maxIter=100, eps=.005/2):
+  """ libsvm's multiclass_probability iteration for k=2, vectorized over
+      pixels (r is the pairwise probability of class 0), so results match
+      SVC.predict_proba """
+  n = r.shape[0]
+  Q00, Q11, Q01 = (1-r)**2, r**2, -r*(1-r)
+  p = np.empty( (2, n) )
+  p.fill(.5)
+  Q = ((Q00, Q01), (Q01, Q11))
+  active = np.ones(n, dtype=bool)
+  for it in range(maxIter):
+    Qp = np.array([ Q[t][0]*p[0] + Q[t][1]*p[1] for t in range(2) ])
+    pQp = p[0]*Qp[0] + p[1]*Qp[1]
+    active &= np.abs(Qp - pQp).max(0) >= eps
+    if not active.any():
+      break
+    for t in range(2):
+      diff = np.where(active, (-Qp[t] + pQp) / Q[t][t], 0.0)
+      p[t] += diff
+      pQp = (pQp + diff*(diff*Q[t][t] + 2*Qp[t])) / (1+diff) / (1+diff)
+      for j in range(2):
+        Qp[j] = (Qp[j] + diff*Q[t][j]) / (1+diff)
+        p[j] /= (1+diff)
+  return p[0]
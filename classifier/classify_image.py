@@ -1,41 +1,148 @@
 import numpy as np
 import pylab as pl
 from PIL import Image
-import os, sys, pickle
+import os, sys, pickle, time, collections
 from glob import glob
-from utils import classify_pixels
+from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
+from utils import classify_pixels, load_pixels
+from parallel import create_pool, get_shared, n_workers
+from bundle import load_model
+from lut import PixelLUT
+from smoothing import ProbSmoother, METHODS
+
+#establish colors: 
+COLORS = ["gray", "green", "teal", "black"]
+
+def decode_pair(task):
+  """ Decodes an EO/IR pair (runs in the prefetch threads) """
+  idx, eoFile, irFile = task
+  start = time.time()
+  eo = load_pixels(eoFile)
+  ir = load_pixels(irFile)
+  return idx, eoFile, irFile, eo, ir, time.time()-start
+
+def prefetch(pool, func, tasks, depth):
+  """ In order map over tasks on a thread pool, keeping at most depth
+      results ahead of the consumer """
+  pending = collections.deque()
+  for task in tasks:
+    pending.append( pool.apply_async(func, (task,)) )
+    if len(pending) > depth:
+      yield pending.popleft().get()
+  while pending:
+    yield pending.popleft().get()
+
+def classify_pair(decoded, model, reducer, outDir, tileRows, lut=None, smoother=None):
+  """ Classifies a decoded pair, writes the class image and returns its timings """
+  idx, eoFile, irFile, eo, ir, decodeTime = decoded
+  start = time.time()
+  img = classify_pixels(eo, ir, reducer, model, COLORS, tileRows, lut, smoother)
+  img.save( os.path.join(outDir, "class_img_%d.png"%idx) )
+  return idx, eoFile, irFile, ir.shape[0]*ir.shape[1], decodeTime, time.time()-start
+
+def _classify_worker(decoded):
+  return classify_pair(decoded, get_shared("model"), get_shared("reducer"),
+                       get_shared("outDir"), get_shared("tileRows"), get_shared("lut"),
+                       get_shared("smoother"))
+
+def write_summary(fname, results, wallTime):
+  """ Per image timing/throughput table plus totals """
+  out = open(fname, 'w')
+  print >> out, "idx\teo\tir\tpixels\tdecode_s\tclassify_s\tMpix_per_s"
+  for idx, eoFile, irFile, npix, decodeTime, classTime in results:
+    print >> out, "%d\t%s\t%s\t%d\t%.3f\t%.3f\t%.3f"%(idx, eoFile, irFile, npix,
+                  decodeTime, classTime, npix / max(classTime, 1e-9) / 1e6)
+  totalPix = sum(r[3] for r in results)
+  summary = "%d images, %d pixels in %.2f s (%.3f Mpix/s, %.2f images/s)"%(len(results),
+            totalPix, wallTime, totalPix / max(wallTime, 1e-9) / 1e6, len(results) / max(wallTime, 1e-9))
+  print >> out, "#", summary
+  out.close()
+  return summary
 
 #### MAIN: classifies pixels for input image ########
 if __name__ == "__main__":
-  if len(sys.argv) < 4: 
+  parser = OptionParser(usage="usage: %prog [options] model.svm imageEO imageIR")
+  parser.add_option("-o", "--outDir", action="store", type="string", dest="outDir", default=".", help="Directory for class images and the timing summary")
+  parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", default=1, help="Number of classification processes (-1 = all cpus)")
+  parser.add_option("-p", "--prefetch", action="store", type="int", dest="prefetch", default=2, help="Number of image decoding threads")
+  parser.add_option("-t", "--tileRows", action="store", type="int", dest="tileRows", default=0, help="Classify images in blocks of this many rows (0 = whole image)")
+  parser.add_option("-l", "--lutBits", action="store", type="int", dest="lutBits", default=-1, help="Classify by table lookup: 0 = exact (memoized distinct pixel tuples), 1-6 = precomputed grid with that many bits per channel (-1 = off)")
+  parser.add_option("-s", "--smooth", action="store", type="string", dest="smooth", default="", help="Spatially smooth class probabilities before labeling: box, gaussian or crf (default off)")
+  parser.add_option("-g", "--sigma", action="store", type="float", dest="sigma", default=1.0, help="Smoothing gaussian sigma (box: radius) in pixels")
+  parser.add_option("-i", "--crfIters", action="store", type="int", dest="crfIters", default=3, help="Mean field iterations of the crf smoother")
+  parser.add_option("-w", "--crfWeight", action="store", type="float", dest="crfWeight", default=2.0, help="Pairwise weight of the crf smoother")
+  (options, args) = parser.parse_args()
+  if len(args) < 3: 
     print "Usage: classifyPixels.py model.svm imageEO imageIR"
     sys.exit(-1)
 
   # grab args
-  modelFile = sys.argv[1]
-  eoName = sys.argv[2]
-  irName = sys.argv[3]
+  modelFile = args[0]
+  eoName = args[1]
+  irName = args[2]
 
   # make image list
   if os.path.isdir(eoName) and os.path.isdir(irName):
     print "classifying every image in dataset"
-    eoFiles = glob.glob(eoName + "/*.png")
-    irFiles = glob.glob(irName + "/*.png")
+    eoFiles = sorted( glob(eoName + "/*.png") )
+    irFiles = sorted( glob(irName + "/*.png") )
     assert len(eoFiles) == len(irFiles)
   else: 
     eoFiles = [eoName]
     irFiles = [irName]
+  if not os.path.exists(options.outDir):
+    os.makedirs(options.outDir)
+
+  # load model once (bundle arrays are memory mapped, shared by the workers)
+  model, reducer, pixelType = load_model(modelFile)
+
+  # optional spatial smoothing of the probabilities
+  smoother = None
+  if options.smooth:
+    if options.smooth not in METHODS:
+      print "Unknown smoothing %s, choose from %s"%(options.smooth, ", ".join(METHODS))
+      sys.exit(-1)
+    smoother = ProbSmoother(options.smooth, options.sigma, options.crfIters, options.crfWeight)
 
-  # load model 
-  inFile = open(modelFile, 'rb')
-  model = pickle.load(inFile)
-  reducer = pickle.load(inFile)
+  # lookup table, built before the workers fork so they inherit it
+  lut = None
+  if options.lutBits >= 0:
+    start = time.time()
+    lut = PixelLUT(reducer, model, options.lutBits or None, withProba=smoother is not None)
+    print "built pixel LUT in %.2f s"%(time.time()-start)
 
-  #establish colors: 
-  colors = ["gray", "green", "teal", "black"]
+  # classification processes start before the decoding threads
+  start = time.time()
+  tasks = zip(range(len(eoFiles)), eoFiles, irFiles)
+  pool = None
+  if n_workers(options.jobs) > 1 and len(tasks) > 1:
+    pool, views = create_pool(options.jobs, {}, model=model, reducer=reducer,
+                              outDir=options.outDir, tileRows=options.tileRows, lut=lut,
+                              smoother=smoother)
+  decoders = ThreadPool(max(1, options.prefetch))
 
-  # runo n each file
-  for idx in range(len(eoFiles)):
-    img = classify_pixels(eoFiles[idx], irFiles[idx], reducer, model, colors); 
-    img.save("class_img_%d.png"%idx )
+  # run on each file, decoding ahead on the threads
+  results = []
+  inflight = collections.deque()
+  for decoded in prefetch(decoders, decode_pair, tasks, max(1, options.prefetch)):
+    if pool:
+      inflight.append( pool.apply_async(_classify_worker, (decoded,)) )
+      if len(inflight) < 2*n_workers(options.jobs):
+        continue
+      r = inflight.popleft().get()
+    else:
+      r = classify_pair(decoded, model, reducer, options.outDir, options.tileRows, lut, smoother)
+    print "class_img_%d.png: %s (%.2f s)"%(r[0], r[1], r[5])
+    results.append(r)
+  while inflight:
+    r = inflight.popleft().get()
+    print "class_img_%d.png: %s (%.2f s)"%(r[0], r[1], r[5])
+    results.append(r)
+  decoders.close()
+  if pool:
+    pool.close()
+    pool.join()
 
+  summary = write_summary(os.path.join(options.outDir, "class_summary.txt"), results, time.time()-start)
+  print summary
@@ -0,0 +1,12 @@
+import sys
+from utils import convert_flat_file
+
+#### MAIN: converts a flat file into a memory mappable binary store ########
+if __name__ == "__main__":
+  if len(sys.argv) < 3:
+    print "Usage: convert_data.py data/train_small.txt data/train_small"
+    sys.exit(-1)
+
+  info = convert_flat_file(sys.argv[1], sys.argv[2])
+  print "Wrote %d labeled and %d noclass rows to %s"%(info["nLabeled"], info["nNull"], sys.argv[2])
+  print info["intToClass"]
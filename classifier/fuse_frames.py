@@ -0,0 +1,185 @@
+import numpy as np
+from PIL import Image, ImageColor
+import os, sys, time
+from glob import glob
+from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
+from utils import classify_proba_block
+from bundle import load_model
+from lut import PixelLUT
+from classify_image import COLORS, decode_pair, prefetch
+
+"""
+Multi frame classification fused on the ground.  Instead of classifying
+every pixel of every frame, the cells of a 2.5D ground grid are projected
+into each frame with its KRT camera (nvm_out/cams_krt), only the pixels
+they land on are classified, and the class probabilities are accumulated
+per cell in one streaming pass over the flight.
+
+The grid is either a regular grid at a constant height (-b bounds, -r
+resolution, -z height) or the height map written by render_depths.py
+(height/x.tiff, y.tiff, z.tiff, one world point per cell).  Occlusion is
+not modeled, every cell in front of a camera and inside its image counts.
+
+Fusion:  log - sum of log probabilities (independent frames, sharpest)
+         mean - average probability (robust to a few bad frames)
+
+Output (outDir): fused_class.png (class colors, black where no frame saw
+the cell), fused_probs.npy (cells x classes), fused_count.npy (frames per
+cell).
+"""
+
+def load_krt(fname):
+  """ (K, R, t) of a vpgl perspective camera text file (K, R rows, then t) """
+  vals = np.array( open(fname, 'r').read().split(), dtype=np.float64 )
+  return vals[:9].reshape(3,3), vals[9:18].reshape(3,3), vals[18:21]
+
+def project(cam, X):
+  """ Image columns, rows and depth of world points X (n x 3) """
+  K, R, t = cam
+  x = np.dot(np.dot(X, R.T) + t, K.T)
+  depth = x[:,2]
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return x[:,0] / depth, x[:,1] / depth, depth
+
+def ground_grid(bounds, resolution, height):
+  """ (rows x cols x 3) world points of a regular grid at constant height """
+  x_min, y_min, x_max, y_max = bounds
+  xs = np.arange(x_min, x_max, resolution)
+  ys = np.arange(y_min, y_max, resolution)
+  X = np.empty( (len(ys), len(xs), 3) )
+  X[:,:,0] = xs[np.newaxis,:]
+  X[:,:,1] = ys[:,np.newaxis]
+  X[:,:,2] = height
+  return X
+
+def height_grid(heightDir):
+  """ (rows x cols x 3) world points of a render_depths.py height map """
+  X = [ np.asarray(Image.open(os.path.join(heightDir, f)), dtype=np.float64)
+        for f in ("x.tiff", "y.tiff", "z.tiff") ]
+  return np.dstack(X)
+
+class FrameFusion:
+  """ Accumulates per cell class probabilities over frames """
+  def __init__(self, grid, fusion="log"):
+    assert fusion in ("log", "mean"), "fusion must be log or mean"
+    self.shape = grid.shape[:2]
+    self.points = grid.reshape(-1, 3)
+    self.fusion = fusion
+    self.acc = None   #cells x classes, allocated by the first frame
+    self.count = np.zeros( len(self.points), dtype=np.uint16 )
+
+  def visible(self, cam, nrows, ncols):
+    """ Cells in front of the camera and inside the image, and their pixels """
+    u, v, depth = project(cam, self.points)
+    cols = np.floor(u).astype(np.int64)
+    rows = np.floor(v).astype(np.int64)
+    cells = np.nonzero( (depth > 0) & (cols >= 0) & (cols < ncols) & (rows >= 0) & (rows < nrows) )[0]
+    return cells, rows[cells], cols[cells]
+
+  def add(self, probs, cells):
+    """ Adds one frame's probabilities (len(cells) x classes) """
+    if self.acc is None:
+      self.acc = np.zeros( (len(self.points), probs.shape[1]), dtype=np.float32 )
+    if self.fusion == "log":
+      probs = np.log(np.maximum(probs, 1e-6))
+    self.acc[cells] += probs
+    self.count[cells] += 1
+
+  def result(self):
+    """ (labels, probabilities, count) grids, labels 255 where unseen """
+    seen = self.count > 0
+    if self.acc is None:
+      self.acc = np.zeros( (len(self.points), 1), dtype=np.float32 )
+    probs = np.zeros_like(self.acc)
+    if self.fusion == "log":
+      z = self.acc[seen] - self.acc[seen].max(1)[:,np.newaxis]
+      np.exp(z, z)
+      probs[seen] = z / z.sum(1)[:,np.newaxis]
+    else:
+      probs[seen] = self.acc[seen] / self.count[seen][:,np.newaxis]
+    labels = np.empty(len(seen), dtype=np.uint8)
+    labels.fill(255)
+    labels[seen] = probs[seen].argmax(1)
+    shape = self.shape
+    return labels.reshape(shape), probs.reshape(shape + (probs.shape[1],)), self.count.reshape(shape)
+
+def classify_frame(fusion, eo, ir, cam, reducer, model, lut=None):
+  """ Classifies the pixels the visible cells land on and accumulates them """
+  cells, rows, cols = fusion.visible(cam, ir.shape[0], ir.shape[1])
+  if len(cells) == 0:
+    return 0
+  #sampled pixels as a one column image block
+  eoS = eo[rows, cols][:,np.newaxis]
+  irS = ir[rows, cols][:,np.newaxis]
+  if lut:
+    probs = lut.proba(eoS, irS)[:,0]
+  else:
+    probs = classify_proba_block(eoS, irS, reducer, model)[:,0]
+  fusion.add(probs, cells)
+  return len(cells)
+
+def save_fused(outDir, labels, probs, count):
+  palette = np.zeros( (256, 3), dtype=np.uint8 )
+  for c, color in enumerate(COLORS):
+    palette[c] = ImageColor.getrgb(color)
+  Image.fromarray(palette[labels]).save( os.path.join(outDir, "fused_class.png") )
+  np.save( os.path.join(outDir, "fused_probs.npy"), probs )
+  np.save( os.path.join(outDir, "fused_count.npy"), count )
+
+#### MAIN: fuses class probabilities of every frame onto the ground ####
+if __name__ == "__main__":
+  parser = OptionParser(usage="usage: %prog [options] model eoDir irDir camDir")
+  parser.add_option("-o", "--outDir", action="store", type="string", dest="outDir", default=".", help="Directory for the fused products")
+  parser.add_option("-m", "--heightMap", action="store", type="string", dest="heightMap", default="", help="render_depths.py height directory (x/y/z.tiff) used as the ground grid")
+  parser.add_option("-b", "--bounds", action="store", type="string", dest="bounds", default="", help="Regular ground grid bounds xmin,ymin,xmax,ymax (instead of -m)")
+  parser.add_option("-r", "--resolution", action="store", type="float", dest="resolution", default=1.0, help="Regular grid cell size (world units)")
+  parser.add_option("-z", "--height", action="store", type="float", dest="height", default=0.0, help="Regular grid ground height")
+  parser.add_option("-f", "--fusion", action="store", type="string", dest="fusion", default="log", help="log (sum of log probabilities) or mean")
+  parser.add_option("-l", "--lutBits", action="store", type="int", dest="lutBits", default=-1, help="Classify by table lookup (see classify_image.py)")
+  parser.add_option("-p", "--prefetch", action="store", type="int", dest="prefetch", default=2, help="Number of image decoding threads")
+  (options, args) = parser.parse_args()
+  if len(args) < 4:
+    parser.print_usage()
+    sys.exit(-1)
+  modelFile, eoDir, irDir, camDir = args[:4]
+
+  eoFiles = sorted( glob(eoDir + "/*.png") )
+  irFiles = sorted( glob(irDir + "/*.png") )
+  camFiles = sorted( glob(camDir + "/*.txt") )
+  if not (len(eoFiles) == len(irFiles) == len(camFiles)):
+    print "Need one EO image, IR image and camera per frame (%d, %d, %d)"%(len(eoFiles), len(irFiles), len(camFiles))
+    sys.exit(-1)
+
+  #ground grid
+  if options.heightMap:
+    grid = height_grid(options.heightMap)
+  elif options.bounds:
+    grid = ground_grid([float(v) for v in options.bounds.split(",")], options.resolution, options.height)
+  else:
+    print "Specify a height map (-m) or grid bounds (-b)"
+    sys.exit(-1)
+  if not os.path.exists(options.outDir):
+    os.makedirs(options.outDir)
+
+  model, reducer, pixelType = load_model(modelFile)
+  lut = None
+  if options.lutBits >= 0:
+    lut = PixelLUT(reducer, model, options.lutBits or None, withProba=True)
+  fusion = FrameFusion(grid, options.fusion)
+  print "fusing %d frames onto a %dx%d grid"%(len(eoFiles), grid.shape[0], grid.shape[1])
+
+  #one streaming pass, decoding ahead on threads
+  start = time.time()
+  decoders = ThreadPool(max(1, options.prefetch))
+  tasks = zip(range(len(eoFiles)), eoFiles, irFiles)
+  for idx, eoFile, irFile, eo, ir, decodeTime in prefetch(decoders, decode_pair, tasks, max(1, options.prefetch)):
+    t = time.time()
+    n = classify_frame(fusion, eo, ir, load_krt(camFiles[idx]), reducer, model, lut)
+    print "%s: %d cells (%.2f s)"%(eoFile, n, time.time()-t)
+  decoders.close()
+
+  labels, probs, count = fusion.result()
+  save_fused(options.outDir, labels, probs, count)
+  print "fused %d frames in %.2f s, %d of %d cells seen"%(len(eoFiles), time.time()-start,
+                                                         np.sum(count > 0), count.size)
@@ -0,0 +1,108 @@
+import numpy as np
+from utils import block_pixels
+
+"""
+Lookup table classification for 8 bit EO/IR imagery.  Pixels are keyed 
+by their (IR, R, G, B) tuple, so each distinct tuple goes through the
+reducer and model once and images are classified with table lookups.
+
+  bits=None : exact - labels are computed for the distinct tuples of each
+              batch and memoized across batches/images
+  bits=1..6 : dense - labels for every cell of a quantized grid (2^bits 
+              levels per channel, cell centers) are precomputed up front
+"""
+
+MAX_BITS = 6
+
+class PixelLUT:
+  def __init__(self, reducer, model, bits=None, withProba=False, blockCells=1<<16):
+    self.reducer = reducer
+    self.model = model
+    self.bits = bits
+    self.withProba = withProba
+    self.blockCells = blockCells
+    if bits is None:
+      #memoized tuples (sorted keys) and their labels/probabilities
+      self.keys = np.zeros(0, dtype=np.uint32)
+      self.labels = np.zeros(0, dtype=np.uint8)
+      self.probs = None
+    else:
+      assert 1 <= bits <= MAX_BITS, "LUT bits must be between 1 and %d"%MAX_BITS
+      self.compile()
+
+  def compile(self):
+    """ Precomputes labels (and probabilities) for every quantized cell """
+    levels = 1 << self.bits
+    nCells = levels**4
+    step = 1 << (8-self.bits)
+    self.labels = np.empty(nCells, dtype=np.uint8)
+    self.probs = None
+    for c0 in range(0, nCells, self.blockCells):
+      cells = np.arange(c0, min(nCells, c0+self.blockCells), dtype=np.uint32)
+      #cell index digits are (IR, R, G, B) levels, take the cell centers
+      ir, eo = self._unpack(cells, levels, step, (step-1)/2.0)
+      labels, probs = self._predict(eo, ir)
+      self.labels[c0:c0+len(cells)] = labels
+      if self.withProba:
+        if self.probs is None:
+          self.probs = np.empty( (nCells, probs.shape[1]), dtype=np.float32 )
+        self.probs[c0:c0+len(cells)] = probs
+
+  def _unpack(self, keys, levels, step, offset):
+    """ (ir, eo) pixel blocks (n x 1 and n x 1 x 3) for packed keys """
+    ir = (keys // levels**3) % levels * step + offset
+    eo = np.empty( (len(keys), 1, 3), dtype=np.float32 )
+    for ch in range(3):
+      eo[:,0,ch] = (keys // levels**(2-ch)) % levels * step + offset
+    return ir.astype(np.float32)[:,np.newaxis], eo
+
+  def _predict(self, eo, ir):
+    X = self.reducer.features(block_pixels(eo, ir))
+    probs = np.array(self.model.predict_proba(X))
+    return probs.argmax(1).astype(np.uint8), probs
+
+  def _keys(self, eo, ir):
+    """ Packed table index of every pixel in a block of 8 bit EO/IR rows """
+    shift = 0 if self.bits is None else 8-self.bits
+    levelBits = 8 - shift
+    keys = (ir.astype(np.uint32) >> shift)
+    for ch in range(3):
+      keys = (keys << levelBits) | (eo[...,ch].astype(np.uint32) >> shift)
+    return keys
+
+  def _lookup(self, keys):
+    """ Table rows for keys, classifying tuples not seen yet (exact mode) """
+    if self.bits is not None:
+      return keys
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    pos = np.searchsorted(self.keys, uniq)
+    known = (pos < len(self.keys))
+    known[known] = self.keys[pos[known]] == uniq[known]
+    if not known.all():
+      self._add(uniq[~known])
+      pos = np.searchsorted(self.keys, uniq)
+    return pos[inverse].reshape(keys.shape)
+
+  def _add(self, newKeys):
+    """ Classifies new tuples and merges them into the memo (kept sorted) """
+    ir, eo = self._unpack(newKeys, 256, 1, 0)
+    labels, probs = self._predict(eo, ir)
+    keys = np.concatenate( (self.keys, newKeys) )
+    order = np.argsort(keys, kind="mergesort")
+    self.keys = keys[order]
+    self.labels = np.concatenate( (self.labels, labels) )[order]
+    if self.withProba:
+      probs = probs.astype(np.float32)
+      self.probs = probs if self.probs is None else np.vstack( (self.probs, probs) )
+      self.probs = self.probs[order]
+
+  def classify(self, eo, ir):
+    """ uint8 class labels for a block of 8 bit EO/IR rows """
+    rows = self._lookup(self._keys(eo, ir))
+    return self.labels[rows]
+
+  def proba(self, eo, ir):
+    """ Class probabilities (rows x cols x classes) for a block of EO/IR rows """
+    assert self.withProba, "LUT was built without probabilities"
+    rows = self._lookup(self._keys(eo, ir))
+    return self.probs[rows]
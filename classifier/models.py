@@ -0,0 +1,65 @@
+from sklearn import svm
+from Features import LDAFeatures, PCAFeatures, NaiveFeatures, IncrementalLDA
+from MultiLogReg import MultiLogReg
+from SoftmaxReg import SoftmaxReg
+from MultiSVM import MultiSVM
+from ApproxSVM import ApproxSVM
+
+"""
+Model type names (train.py -m) and the factory building an unfitted
+(reducer, model) pair for one of them.  The suffix picks the reducer
+(_lda, _pca, or naive features), the prefix the classifier.
+INCREMENTAL_TYPES can also be trained from streamed chunks (partial_fit,
+with an IncrementalLDA reducer for _lda).
+"""
+
+MODEL_TYPES = [ "svm_lda", "svm_pca",
+                "isvm", "isvm_lda", "isvm_pca",
+                "ilogreg", "ilogreg_lda",
+                "softmax", "softmax_lda",
+                "rffsvm", "rffsvm_lda", "nysvm", "nysvm_lda" ]
+
+INCREMENTAL_TYPES = [ "ilogreg", "ilogreg_lda", "softmax", "softmax_lda",
+                      "rffsvm", "rffsvm_lda", "nysvm", "nysvm_lda" ]
+
+#classifiers using the rbf gamma / L2 alpha parameters
+GAMMA_MODELS = ("svm", "isvm", "rffsvm", "nysvm")
+ALPHA_MODELS = ("ilogreg", "softmax", "rffsvm", "nysvm")
+
+def split_type(modelType):
+  """ (classifier, reducer) names of a model type, e.g. (isvm, lda) """
+  if modelType not in MODEL_TYPES:
+    raise ValueError("Unknown model type %s"%modelType)
+  parts = modelType.split("_")
+  return parts[0], (parts[1] if len(parts) > 1 else "naive")
+
+def make_reducer(modelType, complexity=2, cache_dir=None, incremental=False):
+  reducer = split_type(modelType)[1]
+  if reducer == "lda" and incremental:
+    return IncrementalLDA(n_comp=complexity)
+  if reducer == "lda":
+    return LDAFeatures(n_comp=complexity, cache_dir=cache_dir)
+  if reducer == "pca":
+    return PCAFeatures(n_comp=complexity, cache_dir=cache_dir)
+  return NaiveFeatures()
+
+def make_model(modelType, gamma=.7, alpha=.1, batchSize=0, jobs=1):
+  classifier = split_type(modelType)[0]
+  if classifier == "svm":
+    return svm.SVC(kernel='rbf', gamma=gamma, probability=True)
+  if classifier == "isvm":
+    return MultiSVM(n_jobs=jobs, gamma=gamma)
+  if classifier == "ilogreg":
+    return MultiLogReg(alpha=alpha, batch_size=batchSize, n_jobs=jobs)
+  if classifier == "softmax":
+    return SoftmaxReg(alpha=alpha, batch_size=batchSize)
+  method = "rff" if classifier == "rffsvm" else "nystroem"
+  return ApproxSVM(method=method, gamma=gamma, alpha=alpha, batch_size=batchSize)
+
+def build_model(modelType, complexity=2, cache_dir=None, gamma=.7, alpha=.1,
+                batchSize=0, jobs=1, incremental=False):
+  """ Unfitted (reducer, model) for a model type """
+  if incremental and modelType not in INCREMENTAL_TYPES:
+    raise ValueError("%s can not be trained incrementally"%modelType)
+  return make_reducer(modelType, complexity, cache_dir, incremental), \
+         make_model(modelType, gamma, alpha, batchSize, jobs)
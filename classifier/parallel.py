@@ -0,0 +1,64 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing.sharedctypes import RawArray
+
+"""
+Process pool helpers.  Arrays are copied once into shared memory and 
+handed to the workers when the pool starts (inherited through fork, not 
+pickled), so per-task arguments stay small.  Workers read them back with
+get_shared(name).
+"""
+
+#worker side view of the pool's shared arrays/objects
+_shared = {}
+
+def n_workers(n_jobs):
+  """ Number of processes for an n_jobs setting (None/1 serial, -1 all cpus) """
+  if n_jobs is None:
+    return 1
+  if n_jobs < 0:
+    return mp.cpu_count()
+  return max(1, n_jobs)
+
+def share_array(a):
+  """ Copies a into a shared memory buffer, returns (buffer, dtype, shape) """
+  a = np.ascontiguousarray(a)
+  buf = RawArray('b', max(1, a.nbytes))
+  shared = (buf, a.dtype.str, a.shape)
+  shared_view(shared)[...] = a
+  return shared
+
+def shared_view(shared):
+  """ numpy array on top of a buffer from share_array (no copy) """
+  buf, dtype, shape = shared
+  count = int(np.prod(shape))
+  return np.frombuffer(buf, dtype=np.dtype(dtype), count=count).reshape(shape)
+
+def _init_worker(shared, objects):
+  _shared.clear()
+  for name, s in shared.iteritems():
+    _shared[name] = shared_view(s)
+  _shared.update(objects)
+
+def get_shared(name):
+  """ Array (or object) named name in the current worker """
+  return _shared[name]
+
+def create_pool(n_jobs, arrays, **objects):
+  """ Starts a pool of n_jobs workers that see every array in arrays (copied
+      to shared memory) and every keyword object through get_shared.
+      Returns (pool, views) where views are the parent's shared arrays, so
+      workers can also write results into them.
+  """
+  shared = dict( (name, share_array(a)) for name, a in arrays.iteritems() )
+  pool = mp.Pool(n_workers(n_jobs), initializer=_init_worker, initargs=(shared, objects))
+  views = dict( (name, shared_view(s)) for name, s in shared.iteritems() )
+  return pool, views
+
+def run_pool(pool, func, tasks):
+  """ Maps func over tasks, then shuts the pool down """
+  try:
+    return pool.map(func, tasks)
+  finally:
+    pool.close()
+    pool.join()
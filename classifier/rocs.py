@@ -1,74 +1,124 @@
 import numpy as np
 import pylab as pl
-import sys, types, pickle
-from sklearn import svm, metrics
+import sys, types, pickle, json, hashlib
 from Features import LDAFeatures, PCAFeatures
-from utils import RGBIDataset, plot_classifier
+from utils import RGBIDataset, select_pixels
 from optparse import OptionParser
 from Eval import *
 from os.path import basename, splitext
+from bundle import load_model
+from parallel import create_pool, run_pool, get_shared, n_workers
+
+def reducer_key(reducer, pixelType):
+  """ Models whose reducers hash the same share one reduced feature matrix """
+  return hashlib.sha1( pixelType + pickle.dumps(reducer, 2) ).hexdigest()
+
+def downsample_curve(fpr, tpr, maxPoints):
+  """ At most maxPoints evenly spaced points of a curve (keeps both ends) """
+  if len(fpr) <= maxPoints:
+    return fpr, tpr
+  idx = np.unique( np.linspace(0, len(fpr)-1, maxPoints).astype(int) )
+  return fpr[idx], tpr[idx]
+
+def evaluate(model, X, Y, intToClass, maxPoints):
+  """ Per class accuracy, AUC and (downsampled) ROC curve of one model """
+  probs = np.array(model.predict_proba(X))
+  Y_pred = probs.argmax(1)
+  result = { "accuracy" : {}, "auc" : {}, "roc" : {} }
+  for c, (fpr, tpr, thresholds, auc) in enumerate(roc_curves(Y, probs)):
+    name = intToClass[c]
+    num = float(np.sum(Y==c))
+    result["accuracy"][name] = float(np.sum(Y_pred[Y==c]==c)) / num if num else None
+    result["auc"][name] = float(auc)
+    fpr, tpr = downsample_curve(fpr, tpr, maxPoints)
+    result["roc"][name] = { "fpr" : fpr.tolist(), "tpr" : tpr.tolist() }
+  return result
+
+def _evaluate_worker(args):
+  mIdx, group = args
+  return evaluate(get_shared("models")[mIdx], get_shared(group), get_shared("y"),
+                  get_shared("intToClass"), get_shared("maxPoints"))
 
 ###### MAIN ######
 if __name__ == "__main__":
   """ Analyzes ROC curves for multiple saved models, sorts by label """
   # handle inputs
-  parser = OptionParser()
-  parser.add_option("-d", "--testData", action="store", type="string", dest="data", default="", help="Specify testing data file")
-  parser.add_option("-m", "--model", action="store", type="string", dest="model", default="", help="Specify input model to plot/test (e.g. svc_rbf.svm)")
+  parser = OptionParser(usage="usage: %prog [options] testdata.txt model1 model2 ...")
+  parser.add_option("-o", "--out", action="store", type="string", dest="out", default="", help="Write accuracy/AUC/ROC results for every model to this JSON file")
+  parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", default=1, help="Number of processes evaluating models (-1 = all cpus)")
+  parser.add_option("-p", "--points", action="store", type="int", dest="points", default=256, help="Max number of points stored per ROC curve")
+  parser.add_option("-n", "--noplot", action="store_true", dest="noplot", default=False, help="Don't plot the curves")
   (options, args) = parser.parse_args()
 
-  if len(sys.argv) < 2:
+  if len(args) < 2:
     print "Usage: rocs testdata.txt model_glob"
     sys.exit(-1)
   
   #grab models
-  dataFile = sys.argv[1]
-  mFiles = sys.argv[2:]
+  dataFile = args[0]
+  mFiles = args[1:]
   print mFiles
 
   # import some data to play with
   testing = RGBIDataset(dataFile, includeNull=True)
-  Y = testing.target
+  Y = np.asarray(testing.target)
   pixels = testing.pixels
 
-  #grab ROC curve from each model
+  #reduce features once per distinct reducer
+  models, groups, features = [], [], {}
   for mFile in mFiles:
+    model, reducer, pixelType = load_model(mFile)
+    key = "x_" + reducer_key(reducer, pixelType)
+    if key not in features:
+      print "Reducing features for ", mFile
+      features[key] = reducer.features(select_pixels(pixels, pixelType))
+    models.append(model)
+    groups.append(key)
+
+  #evaluate every model (in parallel if asked)
+  tasks = zip(range(len(models)), groups)
+  if n_workers(options.jobs) > 1 and len(models) > 1:
+    arrays = dict(features, y=Y)
+    pool, views = create_pool(options.jobs, arrays, models=models,
+                              intToClass=testing.intToClass, maxPoints=options.points)
+    results = run_pool(pool, _evaluate_worker, tasks)
+  else:
+    results = [ evaluate(models[i], features[g], Y, testing.intToClass, options.points)
+                for i, g in tasks ]
 
-    #read model in - first is model object, second is feature object
-    inFile = open(mFile, 'rb')
-    model = pickle.load(inFile)
-    reducer = pickle.load(inFile)
+  # print accuracy
+  for mFile, group, result in zip(mFiles, groups, results):
+    result["model"] = mFile
+    result["reducer"] = group[2:]
+    print mFile
+    for c, name in enumerate(testing.intToClass):
+      if name not in result["auc"]:   #no probability column (svm.SVC has no null column)
+        continue
+      print "  Class %s (%d) accuracy: %s, auc: %f"%(name, c, result["accuracy"][name], result["auc"][name])
 
-    #predict
-    X = reducer.features(pixels)
-    probs = np.array(model.predict_proba(X))
-    Y_pred = probs.argmax(1)
-    numClasses = probs.shape[1]
+  #machine readable results
+  if options.out:
+    out = open(options.out, 'w')
+    json.dump({ "data" : dataFile, "classes" : testing.intToClass, "models" : results }, out)
+    out.close()
+    print "wrote results to ", options.out
+  if options.noplot:
+    sys.exit(0)
 
-    # print accuracy
-    for c in range(numClasses):
-      correct = float(np.sum(Y_pred[Y==c]==c))
-      num = float(np.sum(Y==c))
-      print "Class %s (%d) accuracy: %f"%(testing.intToClass[c], c, correct/num)
-    
-    #compute ROC curve for each
-    for c in range(numClasses):
-      y_binary = np.ones(len(Y))
-      y_binary[Y==c] = 2
-      print y_binary
-      scores = probs[:,c]
-      fpr, tpr, thresholds = metrics.roc_curve(y_binary, scores)
-      auc = metrics.auc(fpr, tpr)
+  #ROC curve for each label, one line per model
+  for result in results:
+    cleanName,ext = splitext(basename(result["model"].rstrip("/")))
+    for c, name in enumerate(testing.intToClass):
+      if name not in result["roc"]:
+        continue
+      roc = result["roc"][name]
+      lab = "%s auc: %f"%(cleanName, result["auc"][name])
 
-      #label plot
-      cleanName,ext = splitext(basename(mFile))
-      lab = "%s auc: %f"%(cleanName, auc)
-      
       #activate the correct subplot
       spNum = int("22%d"%(c+1))
       pl.subplot(spNum)
-      pl.plot(fpr, tpr, label=lab)
-      pl.title("ROCs for Label: %s"%(testing.intToClass[c]))
+      pl.plot(roc["fpr"], roc["tpr"], label=lab)
+      pl.title("ROCs for Label: %s"%(name))
       pl.legend(loc=4)
 
   pl.show()
@@ -0,0 +1,76 @@
+import numpy as np
+from scipy import ndimage
+
+"""
+Spatial smoothing of per pixel class probabilities, so class maps are not
+decided pixel by pixel.  Works on (rows x cols x classes) probability
+volumes, filtering all class planes at once along each image axis.
+
+  box      : separable box (mean) filter of width 2*radius+1
+  gaussian : separable gaussian filter (sigma, truncated at truncate*sigma)
+  crf      : a few mean field iterations of a Potts CRF with a gaussian
+             spatial kernel, unary log P + weight * smoothed Q
+
+Filtering is local, so an image can be processed in row tiles that carry
+halo rows of context on each side and still match the untiled result.
+"""
+
+METHODS = ("box", "gaussian", "crf")
+
+class ProbSmoother(object):
+  def __init__(self, method="gaussian", sigma=1.0, iterations=3, weight=2.0, truncate=4.0):
+    assert method in METHODS, "smoothing method must be one of %s"%(METHODS,)
+    self.method = method
+    self.sigma = sigma
+    self.iterations = iterations
+    self.weight = weight
+    self.truncate = truncate
+
+  @property
+  def radius(self):
+    """ Reach of one filter pass in pixels """
+    if self.method == "box":
+      return int(round(self.sigma))
+    return int(self.truncate*self.sigma + .5)
+
+  @property
+  def halo(self):
+    """ Rows of context a tile needs on each side to match the whole image """
+    if self.method == "crf":
+      return self.radius * self.iterations
+    return self.radius
+
+  def filter(self, P):
+    """ Separable spatial filter of every class plane, in place """
+    for axis in (0, 1):
+      if self.method == "box":
+        ndimage.uniform_filter1d(P, 2*self.radius+1, axis=axis, output=P, mode="nearest")
+      else:
+        ndimage.gaussian_filter1d(P, self.sigma, axis=axis, output=P, mode="nearest",
+                                  truncate=self.truncate)
+    return P
+
+  def mean_field(self, P):
+    """ Mean field inference, Q starts at P """
+    unary = np.log(np.maximum(P, 1e-6))
+    Q = P.copy()
+    for it in range(self.iterations):
+      self.filter(Q)
+      Q *= self.weight
+      Q += unary
+      #normalize (softmax over classes)
+      Q -= Q.max(2)[:,:,np.newaxis]
+      np.exp(Q, Q)
+      Q /= Q.sum(2)[:,:,np.newaxis]
+    return Q
+
+  def smooth(self, P):
+    """ Smoothed float32 probability volume (P is not modified) """
+    P = np.array(P, dtype=np.float32)
+    if self.method == "crf":
+      return self.mean_field(P)
+    return self.filter(P)
+
+  def labels(self, P):
+    """ uint8 class map of the smoothed volume """
+    return self.smooth(P).argmax(2).astype(np.uint8)
@@ -0,0 +1,153 @@
+import numpy as np
+import sys, os, time, csv, itertools
+from optparse import OptionParser
+from utils import RGBIDataset
+from Features import naive_features
+from Eval import roc_curves
+from models import MODEL_TYPES, GAMMA_MODELS, ALPHA_MODELS, split_type, build_model
+from parallel import create_pool, run_pool, get_shared
+
+"""
+Hyperparameter sweep.  The data set is loaded and its naive features are
+computed once, then every (configuration, fold) pair of a grid of model
+types, gammas, alphas and complexities is fit and scored in a process
+pool that shares the features.  Results (mean and std over the k folds)
+are written as a csv table.
+
+% python sweep.py -d data/train_small.txt -m isvm_lda,softmax_lda -g .1,.7 -a .01,.1 -c 2,3 -f 5 -j -1 -o sweep.csv
+"""
+
+COLUMNS = [ "model", "complexity", "gamma", "alpha",
+            "accuracy", "accuracy_std", "auc", "auc_std",
+            "fit_seconds", "predict_pixels_per_second" ]
+
+def parse_list(s, cast=float):
+  return [ cast(v) for v in s.split(",") if v ]
+
+def grid(modelTypes, complexities, gammas, alphas):
+  """ One configuration dict per point of the grid, only varying the
+      parameters a model type actually uses """
+  configs = []
+  for modelType in modelTypes:
+    classifier, reducer = split_type(modelType)
+    cs = complexities if reducer != "naive" else [None]
+    gs = gammas if classifier in GAMMA_MODELS else [None]
+    als = alphas if classifier in ALPHA_MODELS else [None]
+    for c, g, a in itertools.product(cs, gs, als):
+      configs.append( { "model" : modelType, "complexity" : c, "gamma" : g, "alpha" : a } )
+  return configs
+
+def kfold(n, k, seed=0):
+  """ Fold number of every row, folds are a random partition of equal size """
+  folds = np.empty(n, dtype=np.int32)
+  folds[np.random.RandomState(seed).permutation(n)] = np.arange(n) % k
+  return folds
+
+def mean_auc(Y, probs, nClasses):
+  """ Mean one vs rest AUC over the classes present in Y (columns past
+      nClasses, e.g. the null category, are ignored) """
+  aucs = [ auc for c, (fpr, tpr, th, auc) in enumerate(roc_curves(Y, probs[:,:nClasses]))
+           if np.any(Y==c) ]
+  return float(np.mean(aucs))
+
+def run_config(config, F, Y, train, batchSize=0):
+  """ Fits one configuration on the train rows, scores it on the rest """
+  params = dict( (k, v) for k, v in config.iteritems() if k != "model" and v is not None )
+  reducer, model = build_model(config["model"], batchSize=batchSize, **params)
+  test = ~train
+
+  start = time.time()
+  reducer.fit(None, Y[train], F[train])
+  model.fit(reducer.transform(None, F[train]), Y[train])
+  fitTime = time.time() - start
+
+  start = time.time()
+  probs = np.array(model.predict_proba(reducer.transform(None, F[test])))
+  predictTime = time.time() - start
+
+  Ytest = Y[test]
+  return { "accuracy"   : float(np.mean(probs.argmax(1) == Ytest)),
+           "auc"        : mean_auc(Ytest, probs, int(Y.max())+1),
+           "fit"        : fitTime,
+           "throughput" : len(Ytest) / max(predictTime, 1e-9) }
+
+def _sweep_worker(task):
+  idx, fold = task
+  return run_config(get_shared("configs")[idx], get_shared("F"), get_shared("y"),
+                    get_shared("folds") != fold, get_shared("batchSize"))
+
+def summarize(config, results):
+  """ Table row of a configuration from its per-fold results """
+  acc = [ r["accuracy"] for r in results ]
+  auc = [ r["auc"] for r in results ]
+  row = dict(config)
+  row.update( { "accuracy" : np.mean(acc), "accuracy_std" : np.std(acc),
+                "auc" : np.mean(auc), "auc_std" : np.std(auc),
+                "fit_seconds" : np.mean([ r["fit"] for r in results ]),
+                "predict_pixels_per_second" : np.mean([ r["throughput"] for r in results ]) } )
+  return row
+
+def sweep(F, Y, configs, nFolds=5, jobs=1, batchSize=0, seed=0):
+  """ Runs every configuration on every fold, returns one row per configuration """
+  folds = kfold(len(Y), nFolds, seed)
+  tasks = [ (i, f) for i in range(len(configs)) for f in range(nFolds) ]
+  pool, views = create_pool(jobs, {"F": F, "y": Y, "folds": folds},
+                            configs=configs, batchSize=batchSize)
+  results = run_pool(pool, _sweep_worker, tasks)
+  return [ summarize(configs[i], results[i*nFolds:(i+1)*nFolds]) for i in range(len(configs)) ]
+
+def write_table(fname, rows):
+  out = open(fname, 'wb')
+  writer = csv.DictWriter(out, COLUMNS)
+  writer.writerow( dict(zip(COLUMNS, COLUMNS)) )
+  for row in rows:
+    writer.writerow( dict( (k, "" if row[k] is None else row[k]) for k in COLUMNS ) )
+  out.close()
+
+if __name__ == "__main__":
+  # handle inputs
+  parser = OptionParser()
+  parser.add_option("-d", "--data", action="store", type="string", dest="data", default="", help="Specify training data file or binary store")
+  parser.add_option("-m", "--modelTypes", action="store", type="string", dest="modelTypes", default="isvm_lda,ilogreg_lda,softmax_lda", help="Comma separated model types to sweep")
+  parser.add_option("-g", "--gammas", action="store", type="string", dest="gammas", default=".7", help="Comma separated rbf gammas (svm models)")
+  parser.add_option("-a", "--alphas", action="store", type="string", dest="alphas", default=".1", help="Comma separated L2 strengths (logistic/softmax/approximate svm models)")
+  parser.add_option("-c", "--complexities", action="store", type="string", dest="complexities", default="2", help="Comma separated reduced dimensions (lda/pca models)")
+  parser.add_option("-f", "--folds", action="store", type="int", dest="folds", default=5, help="Number of cross validation folds")
+  parser.add_option("-b", "--batchSize", action="store", type="int", dest="batchSize", default=0, help="SGD batch size passed to the models (0 = full batch)")
+  parser.add_option("-n", "--maxPerClass", action="store", type="int", dest="maxPerClass", default=0, help="Sample at most this many pixels per class (0 = use all)")
+  parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", default=1, help="Number of processes (-1 = all cpus)")
+  parser.add_option("-p", "--pixels", action="store", type="string", dest="pixels", default="all", help="Specify which pixels to use, EO, IR, or all")
+  parser.add_option("-o", "--out", action="store", type="string", dest="out", default="sweep.csv", help="Output csv table")
+  (options, args) = parser.parse_args()
+  print options
+
+  if not os.path.exists(options.data):
+    print "No data file!"
+    sys.exit(-1)
+  modelTypes = parse_list(options.modelTypes, str)
+  for modelType in modelTypes:
+    if modelType not in MODEL_TYPES:
+      print "Unknown model type %s, choose from %s"%(modelType, ", ".join(MODEL_TYPES))
+      sys.exit(-1)
+
+  # load once, naive features once
+  data = RGBIDataset(options.data, maxPerClass=options.maxPerClass)
+  pixels = data.pixels
+  if options.pixels == "EO":
+    pixels = pixels[:,1:4]
+  elif options.pixels == "IR":
+    pixels = pixels[:,0]
+  F = naive_features(pixels)
+  Y = np.asarray(data.target, dtype=np.int32)
+
+  configs = grid(modelTypes, parse_list(options.complexities, int),
+                 parse_list(options.gammas), parse_list(options.alphas))
+  print "Sweeping %d configurations x %d folds over %d pixels"%(len(configs), options.folds, len(Y))
+  rows = sweep(F, Y, configs, options.folds, options.jobs, options.batchSize)
+  write_table(options.out, rows)
+
+  for row in sorted(rows, key=lambda r: -r["auc"]):
+    print "%-12s c=%-4s gamma=%-6s alpha=%-6s acc %.4f auc %.4f fit %.2fs %.0f px/s"%(
+      row["model"], row["complexity"], row["gamma"], row["alpha"], row["accuracy"],
+      row["auc"], row["fit_seconds"], row["predict_pixels_per_second"])
+  print "Wrote", options.out
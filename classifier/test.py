@@ -1,11 +1,11 @@
 import numpy as np
 import pylab as pl
 import sys, random, types, pickle
-from sklearn import svm, metrics
 from Features import LDAFeatures, PCAFeatures
 from utils import RGBIDataset, plot_classifier
 from optparse import OptionParser
 from Eval import *
+from bundle import load_model
 
 
 ###### MAIN ######
@@ -16,18 +16,17 @@ if __name__ == "__main__":
   parser.add_option("-d", "--testData", action="store", type="string", dest="data", default="", help="Specify testing data file")
   parser.add_option("-m", "--model", action="store", type="string", dest="model", default="", help="Specify input model to plot/test (e.g. svc_rbf.svm)")
   parser.add_option("-v", "--visualize", action="store_true", dest="visualize", default=False, help="Visualize results of material classifier")
+  parser.add_option("-b", "--batch", action="store", type="int", dest="batch", default=65536, help="Number of test pixels reduced/predicted at a time")
+  parser.add_option("-k", "--cache", action="store", type="string", dest="cache", default=None, help="Directory caching -v decision surfaces between runs")
   (options, args) = parser.parse_args()
 
-  # import some data to play with
+  # import some data to play with (binary stores are memory mapped)
   testing = RGBIDataset(options.data, includeNull=True)
   Y = testing.target
   pixels = testing.pixels
 
-  #read model in - first is model object, second is feature object
-  inFile = open(options.model, 'rb')
-  model = pickle.load(inFile)
-  reducer = pickle.load(inFile)
-  pixelType = pickle.load(inFile)
+  #read model in (bundle or old pickle file)
+  model, reducer, pixelType = load_model(options.model)
   print "Testing on pixel type: ", pixelType
 
   #grab appropriate pixels
@@ -40,50 +39,51 @@ if __name__ == "__main__":
   else:
     print "Unrecognized type %s !!!!"%pixelType
     sys.exit(-1)
-
-  #reduce pixel features
-  X = reducer.features(pixels)
   for c,v in testing.classMap.iteritems():
     print "%s (%d): %d items in training set"%(c,v,np.sum(Y==v))
- 
-  # PREDICT
-  probs = np.array(model.predict_proba(X))
-  numClasses = probs.shape[1]
+
+  # PREDICT, a batch at a time (only the metrics are kept)
+  acc = None
+  x_graph, y_graph = [], []
+  for r0 in range(0, len(Y), options.batch):
+    y_batch = np.asarray(Y[r0:r0+options.batch])
+    X = reducer.features(pixels[r0:r0+options.batch])
+    probs = np.array(model.predict_proba(X))
+    if acc is None:
+      acc = MetricsAccumulator(max(len(testing.intToClass), probs.shape[1]))
+    acc.update(y_batch, probs)
+
+    #keep labeled points for the plot
+    if options.visualize:
+      labeled = y_batch != testing.classMap.get("noclass", -1)
+      x_graph.append(X[labeled])
+      y_graph.append(y_batch[labeled])
+  numClasses = acc.nClasses
   
   #visualize model if called for
   if options.visualize:
-    y_graph = Y[testing.classes!="noclass"]
-    x_graph = X[testing.classes!="noclass"]
+    y_graph = np.concatenate(y_graph)
+    x_graph = np.vstack(x_graph)
     print "shapes: ", y_graph.shape, x_graph.shape
-    plot_classifier(x_graph, y_graph, model, testing.classMap)
+    plot_classifier(x_graph, y_graph, model, testing.classMap, cache_dir=options.cache)
 
   #confusion matrix and accuracy
-  Y_pred = probs.argmax(1)
-  confMat = metrics.confusion_matrix(Y, Y_pred)
-  printConfusionMatrix(confMat, testing.intToClass)
+  printConfusionMatrix(acc.confusion, testing.intToClass)
   
   #classification report?
-  report = metrics.classification_report(Y, Y_pred, target_names=testing.intToClass)
+  report = acc.report(testing.intToClass)
   print report
 
   # print accuracy
+  accuracy = acc.class_accuracy()
   for c in range(numClasses):
-    correct = float(np.sum(Y_pred[Y==c]==c))
-    num = float(np.sum(Y==c))
-    print "Class %s (%d) accuracy: %f"%(testing.intToClass[c], c, correct/num)
+    print "Class %s (%d) accuracy: %f"%(testing.intToClass[c], c, accuracy[c])
 
   #testing data from second image
   #compute ROC curve for each
   for c in range(numClasses):
-    y_binary = np.ones(len(Y))
-    y_binary[Y==c] = 2
-    print y_binary
-    scores = probs[:,c]
-    fpr, tpr, thresholds = metrics.roc_curve(y_binary, scores)
-    auc = metrics.auc(fpr, tpr)
+    fpr, tpr, auc = acc.roc(c)
     lab = "%s auc: %f"%(testing.intToClass[c], auc)
     pl.plot(fpr, tpr, label=lab)
   pl.legend()
   pl.show()
-
-
@@ -1,23 +1,54 @@
 import numpy as np
 import pylab as pl
-import  pickle, os
+import sys, pickle, os, time
 from sklearn import svm, datasets
 from optparse import OptionParser
-from utils import RGBIDataset, plot_classifier
+from utils import RGBIDataset, plot_classifier, select_pixels, stream_info, stream_chunks
 import Features
-from Features import LDAFeatures, PCAFeatures, NaiveFeatures
-from LogReg import LogReg
-from MultiLogReg import MultiLogReg
-from MultiSVM import MultiSVM
+from Features import LDAFeatures, PCAFeatures, NaiveFeatures, IncrementalLDA, naive_features
+from models import MODEL_TYPES, INCREMENTAL_TYPES, build_model
+from bundle import save_bundle
+
+def train_incremental(options):
+  """ Out of core training: the data is streamed in chunks of
+      options.incremental rows, one pass accumulates the incremental LDA
+      statistics (lda models), then each epoch partial_fits the model on
+      every chunk (shuffled).  Returns (reducer, model, classMap). 
+  """
+  intToClass, nRows = stream_info(options.data)
+  classes = range(len(intToClass))
+  print "Streaming %d rows of %s in chunks of %d"%(nRows, intToClass, options.incremental)
+  reducer, model = build_model(options.modelType, complexity=options.complexity,
+                               gamma=options.gamma, alpha=options.alpha,
+                               batchSize=options.batchSize or 256, incremental=True)
+  chunks = lambda seed: stream_chunks(options.data, options.incremental, shuffle=True, seed=seed)
+  if isinstance(reducer, IncrementalLDA):
+    for pixels, Y in chunks(0):
+      reducer.partial_fit(None, Y, naive_features(select_pixels(pixels, options.pixels)))
+  for epoch in range(options.epochs):
+    start = time.time()
+    for pixels, Y in chunks(epoch):
+      F = naive_features(select_pixels(pixels, options.pixels))
+      model.partial_fit(reducer.transform(None, F), Y, classes, nRows)
+    print "epoch %d: %.2f s"%(epoch, time.time()-start)
+  return reducer, model, dict( (c,i) for i,c in enumerate(intToClass) )
 
 if __name__ == "__main__":
   # handle inputs
   parser = OptionParser()
   parser.add_option("-d", "--data", action="store", type="string", dest="data", default="", help="Specify training data file (flatfile generated from boxm2 classify)")
-  parser.add_option("-s", "--save", action="store", type="string", dest="modelOut", default="", help="Specify model output file (e.g. svc_rbf.svm)")
+  parser.add_option("-s", "--save", action="store", type="string", dest="modelOut", default="", help="Specify model output bundle directory (e.g. svc_rbf.model)")
   parser.add_option("-m", "--modelType", action="store", type="string", dest="modelType", default="svm_lda", help="Specify type of model to learn")
+  parser.add_option("-g", "--gamma", action="store", type="float", dest="gamma", default=.7, help="RBF kernel gamma of the svm models")
+  parser.add_option("-a", "--alpha", action="store", type="float", dest="alpha", default=.1, help="L2 regularization of the logistic/softmax/approximate svm models")
   parser.add_option("-v", "--visualize", action="store_true", dest="visualize", default=False, help="Visualize results of material classifier")
   parser.add_option("-c", "--complexity", action="store", type="int", dest="complexity", default=2, help="Specify dimensionality of reduced data set (for lda/pca models)")
+  parser.add_option("-b", "--batchSize", action="store", type="int", dest="batchSize", default=0, help="Train logistic models with mini-batch SGD using this batch size (0 = full batch BFGS)")
+  parser.add_option("-j", "--jobs", action="store", type="int", dest="jobs", default=1, help="Number of processes for one-vs-rest models (-1 = all cpus)")
+  parser.add_option("-k", "--cache", action="store", type="string", dest="cache", default=None, help="Directory caching fitted LDA/PCA projections (and -v decision surfaces) between runs")
+  parser.add_option("-n", "--maxPerClass", action="store", type="int", dest="maxPerClass", default=0, help="Randomly sample at most this many training pixels per class (0 = use all)")
+  parser.add_option("-i", "--incremental", action="store", type="int", dest="incremental", default=0, help="Train out of core on chunks of this many rows streamed from disk (0 = load everything)")
+  parser.add_option("-e", "--epochs", action="store", type="int", dest="epochs", default=5, help="Passes over the data in incremental mode")
   parser.add_option("-p", "--pixels", action="store", type="string", dest="pixels", default="all", help="Specify which pixels to use, EO, IR, or all")
   (options, args) = parser.parse_args()
   print options
@@ -29,69 +60,43 @@ if __name__ == "__main__":
   if options.modelOut == "":
     print "No output model file!"
     sys.exit(-1)
+  if options.modelType not in MODEL_TYPES:
+    print "Unknown model type %s, choose from %s"%(options.modelType, ", ".join(MODEL_TYPES))
+    sys.exit(-1)
+  if options.incremental and options.modelType not in INCREMENTAL_TYPES:
+    print "Model type %s can not be trained incrementally, choose from %s"%(options.modelType, ", ".join(INCREMENTAL_TYPES))
+    sys.exit(-1)
+
+  #out of core training, memory is bounded by the chunk size
+  if options.incremental:
+    reducer, model, classMap = train_incremental(options)
+    print "Model learned: %s"%model
+    print "saving model as ", options.modelOut
+    save_bundle(options.modelOut, model, reducer, options.pixels)
+    sys.exit(0)
 
   # import raw training data
-  training = RGBIDataset(options.data)
+  training = RGBIDataset(options.data, maxPerClass=options.maxPerClass)
   Y = training.target
-  if options.pixels == "all":
-    pixels = training.pixels
-  elif options.pixels == "EO":
-    pixels = training.pixels[:,1:4]
-  elif options.pixels == "IR": 
-    pixels = training.pixels[:,0]
+  pixels = select_pixels(training.pixels, options.pixels)
   for c,v in training.classMap.iteritems():
     print c, ":", np.sum(Y==v), "items in training set"
 
   #Train classifiers
   print "Learning ",options.modelType
-  if options.modelType=="svm_lda":
-    reducer = LDAFeatures(n_comp=options.complexity) #reduces features (using LDA)
-    X = reducer.features(pixels, Y) #creates features
-    model = svm.SVC(kernel='rbf', gamma=0.7, probability=True).fit(X, Y)
-  if options.modelType=="svm_pca":
-    reducer = PCAFeatures(n_comp=self.complexity)
-    X = reducer.features(pixels)
-    model = svm.SVC(kernel="rbf", gamma=0.7, probability=True).fit(X,Y)
-  
-  #Independent svm models
-  if options.modelType=="isvm":
-    reducer = NaiveFeatures()
-    X = reducer.features(pixels)
-    model = MultiSVM()
-    model.fit(X,Y)
-  if options.modelType=="isvm_lda":
-    reducer = LDAFeatures(n_comp=options.complexity)
-    X = reducer.features(pixels, Y)
-    model = MultiSVM()
-    model.fit(X,Y)
-  if options.modelType=="isvm_pca":
-    reducer = PCAFeatures(n_comp=options.complexity)
-    X = reducer.features(pixels)
-    model = MultiSVM()
-    model.fit(X,Y)  
-  
-  #Logistic Regression
-  if options.modelType=="ilogreg":
-    reducer = NaiveFeatures()
-    X = reducer.features(pixels)
-    model = MultiLogReg()
-    model.fit(X,Y)
-  if options.modelType=="ilogreg_lda":
-    reducer = LDAFeatures(n_comp=options.complexity)
-    X = reducer.features(pixels, Y) 
-    model = MultiLogReg()
-    model.fit(X,Y)
+  reducer, model = build_model(options.modelType, complexity=options.complexity,
+                               cache_dir=options.cache, gamma=options.gamma,
+                               alpha=options.alpha, batchSize=options.batchSize,
+                               jobs=options.jobs)
+  X = reducer.features(pixels, Y) #creates features (fits LDA/PCA)
+  model.fit(X,Y)
 
   #write model out if specified
   print "Model learned: %s"%model
   print "saving model as ", options.modelOut
-  out = open(options.modelOut, 'wb')
-  pickle.dump(model, out)
-  pickle.dump(reducer, out)
-  pickle.dump(options.pixels, out)
-  out.close()
+  save_bundle(options.modelOut, model, reducer, options.pixels)
 
   #visualize model if called for
   if options.visualize:
-    plot_classifier(X,Y,model,training.classMap)
+    plot_classifier(X,Y,model,training.classMap,cache_dir=options.cache)
 
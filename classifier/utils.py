@@ -1,17 +1,99 @@
 import numpy as np
 import pylab as pl
 from PIL import Image, ImageColor
-import random, types, pickle
+import random, types, pickle, os, json, shutil, hashlib
 
 class RGBIDataset:
   """ Load dataset from flat file - has data and target 
       NOTE: all classes are numbered in alphabetical order
             for consistency (noclass is always LAST)
+      fname can also be a binary store directory (see convert_flat_file),
+      which is memory mapped instead of parsed
+      With maxPerClass set, at most that many rows of each class are kept,
+      sampled uniformly (reservoir sampling, fixed seed) in a single pass
   """
-  def __init__(self, fname, includeNull=False):
+  def __init__(self, fname, includeNull=False, maxPerClass=None, seed=0):
     self.classes = []
     self.includeNull = includeNull
-    self.load_flat_file(fname)
+    self.maxPerClass = maxPerClass
+    self.seed = seed
+    if os.path.isdir(fname):
+      self.load_binary_store(fname)
+      if maxPerClass:
+        self.sample_binary_store()
+    elif maxPerClass:
+      self.load_flat_sample(fname)
+    else:
+      self.load_flat_file(fname)
+
+  def load_binary_store(self, dirName):
+    """ Memory maps a store written by convert_flat_file.  Pixels and
+        target are read-only views on the files (no copies), noclass rows
+        are stored last so excluding them is just a slice.
+        NOTE: per-row class names (self.classes) are not kept
+    """
+    info = json.load(open(os.path.join(dirName, STORE_INFO), 'r'))
+    nRows = info["nLabeled"]
+    if self.includeNull:
+      nRows += info["nNull"]
+    shape = (info["nLabeled"] + info["nNull"], info["nDims"])
+    self.pixels = np.memmap(os.path.join(dirName, STORE_PIXELS), dtype=np.float32,
+                            mode='r', shape=shape)[:nRows]
+    self.target = np.memmap(os.path.join(dirName, STORE_TARGET), dtype=np.uint8,
+                            mode='r', shape=(shape[0],))[:nRows]
+    self.classes = None
+    self.intToClass = [str(c) for c in info["intToClass"]]
+    if not self.includeNull and "noclass" in self.intToClass:
+      self.intToClass.remove("noclass")
+    self.classMap = dict( (c,i) for i,c in enumerate(self.intToClass) )
+    print self.classMap
+    print self.intToClass
+
+  def sample_binary_store(self):
+    """ Keeps at most maxPerClass rows per class of a mapped store, copying
+        only the sampled rows (kept in file order) """
+    rng = np.random.RandomState(self.seed)
+    keep = []
+    for c in range(len(self.intToClass)):
+      idx = np.nonzero(self.target == c)[0]
+      if len(idx) > self.maxPerClass:
+        idx = np.sort( rng.choice(idx, self.maxPerClass, replace=False) )
+      keep.append(idx)
+    keep = np.sort( np.concatenate(keep) )
+    self.pixels = np.asarray(self.pixels[keep])
+    self.target = np.asarray(self.target[keep])
+    print "Sampled %d rows (at most %d per class)"%(len(keep), self.maxPerClass)
+
+  def load_flat_sample(self, fname):
+    """ Single pass per class reservoir sampling of a flat file, memory is
+        bounded by maxPerClass * number of classes """
+    rng = random.Random(self.seed)
+    reservoirs = {}   #class -> [rows seen, sampled rows]
+    for line in open(fname, 'r'):
+      l = line.split()
+      datClass = l[0]
+      if datClass == "noclass" and self.includeNull==False:
+        continue
+      if not reservoirs.has_key(datClass):
+        reservoirs[datClass] = [0, []]
+      res = reservoirs[datClass]
+      res[0] += 1
+      if len(res[1]) < self.maxPerClass:
+        res[1].append(l[1:])
+      else:
+        j = rng.randint(0, res[0]-1)
+        if j < self.maxPerClass:
+          res[1][j] = l[1:]
+
+    #stack the reservoirs (in class order)
+    pixels = []
+    tempMap = {}
+    for datClass in sorted(reservoirs.iterkeys()):
+      tempMap[datClass] = len(tempMap)
+      self.classes += [datClass] * len(reservoirs[datClass][1])
+      pixels += reservoirs[datClass][1]
+      print "%s: sampled %d of %d rows"%(datClass, len(reservoirs[datClass][1]), reservoirs[datClass][0])
+    self.set_classes(np.array(pixels, dtype=np.float64), tempMap)
 
   def load_flat_file(self,fname):
     f = open(fname, 'r')
@@ -32,9 +114,12 @@ class RGBIDataset:
       #keep track of string names, equivalent int, and float data
       self.classes.append( l[0] )
       pixels.append( [float(x) for x in l[1:]] );
+    self.set_classes(np.array(pixels), tempMap)
 
+  def set_classes(self, pixels, tempMap):
+    """ Sets pixels and numbers the classes (self.classes holds per row names) """
     #alphabetize classes
-    self.pixels = np.array(pixels)
+    self.pixels = pixels
     self.target = np.zeros(len(pixels))
     self.classes = np.array(self.classes)
     self.intToClass = []
@@ -54,10 +139,182 @@ class RGBIDataset:
     #self.intToClass.append("noclass")
     print self.classMap
     print self.intToClass
-    
 
-def plot_classifier(X, Y, models, classMap=None):
-  """ Plots classifier or classifiers on 2d plot """
+
+#binary store file names (see convert_flat_file)
+STORE_PIXELS = "pixels.f32"
+STORE_TARGET = "target.u8"
+STORE_INFO   = "classes.json"
+
+def convert_flat_file(fname, outDir, chunkSize=65536):
+  """ One time conversion of a boxm2 classify flat file into a binary store
+      directory that RGBIDataset memory maps:
+        pixels.f32   - float32 pixel matrix (row major)
+        target.u8    - uint8 class id per row
+        classes.json - class names (alphabetical, noclass last) and shape
+      Labeled rows keep their file order, noclass rows are moved to the end.
+      The file is streamed in chunks so memory stays bounded.
+  """
+  if not os.path.exists(outDir):
+    os.makedirs(outDir)
+  pixFile = open(os.path.join(outDir, STORE_PIXELS), 'wb')
+  tarFile = open(os.path.join(outDir, STORE_TARGET), 'wb')
+  nullName = os.path.join(outDir, STORE_PIXELS + ".noclass")
+  nullFile = open(nullName, 'wb')
+
+  tempMap = {}  #temporary, unsorted class map
+  rows, ids, nulls = [], [], []
+  nLabeled, nNull, nDims = 0, 0, None
+  for line in open(fname, 'r'):
+    l = line.split()
+    if len(l) == 0:
+      continue
+    if nDims is None:
+      nDims = len(l) - 1
+
+    #noclass rows go to their own file, appended at the end
+    datClass = l[0]
+    if datClass == "noclass":
+      nulls.append(l[1:])
+    else:
+      if not tempMap.has_key(datClass):
+        #ids are written as uint8 as they come, fail before they wrap
+        if len(tempMap) == 255:
+          raise ValueError("Binary store supports at most 255 classes")
+        tempMap[datClass] = len(tempMap)
+      rows.append(l[1:])
+      ids.append(tempMap[datClass])
+
+    #flush full chunks
+    if len(rows) >= chunkSize:
+      nLabeled += _write_rows(pixFile, rows, tarFile, ids)
+      rows, ids = [], []
+    if len(nulls) >= chunkSize:
+      nNull += _write_rows(nullFile, nulls)
+      nulls = []
+  nLabeled += _write_rows(pixFile, rows, tarFile, ids)
+  nNull += _write_rows(nullFile, nulls)
+
+  #append noclass rows after labeled rows
+  nullFile.close()
+  nullFile = open(nullName, 'rb')
+  shutil.copyfileobj(nullFile, pixFile)
+  nullFile.close()
+  os.remove(nullName)
+  pixFile.close()
+
+  # alphabetize classes, noclass is always last
+  sortedKeys = sorted(tempMap.iterkeys())
+  lut = np.zeros(256, dtype=np.uint8)
+  for count, key in enumerate(sortedKeys):
+    lut[tempMap[key]] = count
+  if nNull > 0:
+    sortedKeys.append("noclass")
+    nullIds = np.empty(nNull, dtype=np.uint8)
+    nullIds.fill(len(sortedKeys)-1)
+    tarFile.write( nullIds.tostring() )
+  tarFile.close()
+
+  #remap first-seen class ids of labeled rows to sorted ids
+  if nLabeled > 0:
+    target = np.memmap(os.path.join(outDir, STORE_TARGET), dtype=np.uint8, mode='r+')
+    for start in range(0, nLabeled, chunkSize):
+      chunk = target[start:min(start+chunkSize, nLabeled)]
+      chunk[:] = lut[chunk]
+    target.flush()
+    del target
+
+  info = { "intToClass" : sortedKeys,
+           "nLabeled"   : nLabeled,
+           "nNull"      : nNull,
+           "nDims"      : nDims }
+  json.dump(info, open(os.path.join(outDir, STORE_INFO), 'w'), indent=2)
+  return info
+
+def _write_rows(pixFile, rows, tarFile=None, ids=None):
+  """ Appends string rows as float32 (and class ids as uint8) """
+  if len(rows) == 0:
+    return 0
+  pixFile.write( np.array(rows, dtype=np.float32).tostring() )
+  if tarFile:
+    tarFile.write( np.array(ids, dtype=np.uint8).tostring() )
+  return len(rows)
+
+def select_pixels(pixels, pixelType):
+  """ Pixel columns a model was trained on (pixel type all, EO or IR) """
+  if pixelType == "EO":
+    return pixels[:,1:4]
+  if pixelType == "IR":
+    return pixels[:,0]
+  return pixels
+
+def stream_info(fname, includeNull=False):
+  """ (intToClass, number of rows) of a flat file or binary store, without
+      loading the pixels (flat files are scanned for their labels only) """
+  if os.path.isdir(fname):
+    info = json.load(open(os.path.join(fname, STORE_INFO), 'r'))
+    intToClass = [str(c) for c in info["intToClass"]]
+    if includeNull:
+      return intToClass, info["nLabeled"] + info["nNull"]
+    if "noclass" in intToClass:
+      intToClass.remove("noclass")
+    return intToClass, info["nLabeled"]
+
+  counts = {}
+  for line in open(fname, 'r'):
+    l = line.split(None, 1)
+    if len(l) == 0 or (l[0] == "noclass" and not includeNull):
+      continue
+    counts[l[0]] = counts.get(l[0], 0) + 1
+  intToClass = sorted(c for c in counts.iterkeys() if c != "noclass")
+  if "noclass" in counts:
+    intToClass.append("noclass")
+  return intToClass, sum(counts.itervalues())
+
+def stream_chunks(fname, chunkRows=65536, includeNull=False, shuffle=False, seed=0):
+  """ Yields (float32 pixels, int target) chunks of a flat file or binary
+      store, numbered like RGBIDataset, so data sets that do not fit in memory
+      can be trained on incrementally.  With shuffle, rows within each chunk
+      are permuted, and store chunks are also visited in random order.
+  """
+  rng = np.random.RandomState(seed)
+  intToClass, nRows = stream_info(fname, includeNull)
+  classMap = dict( (c,i) for i,c in enumerate(intToClass) )
+
+  def finish(pixels, target):
+    if shuffle:
+      perm = rng.permutation(len(target))
+      pixels, target = pixels[perm], target[perm]
+    return pixels, target
+
+  if os.path.isdir(fname):
+    data = RGBIDataset(fname, includeNull)   #memory mapped, nothing is read yet
+    starts = np.arange(0, nRows, chunkRows)
+    if shuffle:
+      starts = rng.permutation(starts)
+    for start in starts:
+      yield finish( np.array(data.pixels[start:start+chunkRows]),
+                    np.array(data.target[start:start+chunkRows], dtype=int) )
+    return
+
+  rows, ids = [], []
+  for line in open(fname, 'r'):
+    l = line.split()
+    if len(l) == 0 or (l[0] == "noclass" and not includeNull):
+      continue
+    rows.append(l[1:])
+    ids.append(classMap[l[0]])
+    if len(rows) == chunkRows:
+      yield finish( np.array(rows, dtype=np.float32), np.array(ids) )
+      rows, ids = [], []
+  if len(rows) > 0:
+    yield finish( np.array(rows, dtype=np.float32), np.array(ids) )
+
+
+def plot_classifier(X, Y, models, classMap=None, size=512, maxPoints=5000, cache_dir=None):
+  """ Plots classifier or classifiers on 2d plot.  The decision surface
+      comes from decision_surface (adaptive, cached in cache_dir if given)
+      and at most maxPoints points of each class are drawn. """
   #handle single model
   if not isinstance(models, types.ListType):
     models = [models]
@@ -70,73 +327,195 @@ def plot_classifier(X, Y, models, classMap=None):
   #colors for different decisions
   colors = ["red", "green", "blue", "yellow", "black"]
 
-  # create a mesh to plot in
-  h = 500  # step size in mesh
-  x_min, x_max = X[:, 0].min() - .002, X[:, 0].max() + .002
-  y_min, y_max = X[:, 1].min() - .002, X[:, 1].max() + .002
-  xx, yy = np.meshgrid(np.arange(x_min, x_max, (x_max-x_min)/h),
-                       np.arange(y_min, y_max, (y_max-y_min)/h))
+  # bounds of the plot
+  bounds = (X[:, 0].min() - .002, X[:, 0].max() + .002,
+            X[:, 1].min() - .002, X[:, 1].max() + .002)
+  rng = np.random.RandomState(0)
   
   #set cmap
   pl.set_cmap(pl.cm.Paired)
   for mi, clf in enumerate( models ):
-    # Plot the decision boundary. For that, we will asign a color to each
-    # point in the mesh [x_min, m_max]x[y_min, y_max].
+    # Plot the decision regions as one image
     pl.subplot(1, len(models), mi + 1)
-    Z = clf.predict(np.c_[xx.ravel(), yy.ravel()])
-
-    # Put the result into a color plot
-    Z = Z.reshape(xx.shape)
-    pl.set_cmap(pl.cm.Paired)
-    pl.contourf(xx, yy, Z)
+    Z = decision_surface(clf, bounds, size, cache_dir=cache_dir)
+    pl.imshow(Z, origin="lower", extent=bounds, aspect="auto",
+              interpolation="nearest", cmap=pl.cm.Paired)
     #pl.axis('off')
 
-    # Plot also the training points
+    # Plot also the training points (subsampled)
     if classMap:
       for c,i in classMap.iteritems():
         x = X[Y==i] 
-        pl.plot(x[:,0], x[:,1], "o", c=colors[i], label=c) 
+        if len(x) > maxPoints:
+          x = x[rng.choice(len(x), maxPoints, replace=False)]
+        pl.plot(x[:,0], x[:,1], "o", c=colors[i % len(colors)], label=c) 
 
     #legend and title
     pl.legend()
     pl.title(titles[mi])
   pl.show()
 
+def surface_key(clf, bounds, size, coarse):
+  """ sha1 of the pickled model and the plotted grid """
+  h = hashlib.sha1( pickle.dumps(clf, 2) )
+  h.update( repr( (tuple(float(b) for b in bounds), size, coarse) ) )
+  return h.hexdigest()
 
+def decision_surface(clf, bounds, size=512, coarse=16, cache_dir=None):
+  """ size x size image of clf.predict labels over bounds (x_min, x_max,
+      y_min, y_max), row 0 at y_min.  The grid is evaluated coarse to fine:
+      labels are predicted on a lattice of spacing size/coarse, and only
+      the cells whose corner labels differ are split (halving the spacing)
+      and evaluated further, uniform cells are filled with their label.
+      With cache_dir set, surfaces are stored there keyed by the model
+      contents, bounds and size, so replotting the same model is free.
+  """
+  if cache_dir:
+    fname = os.path.join(cache_dir, "surface_%s.npy"%surface_key(clf, bounds, size, coarse))
+    if os.path.exists(fname):
+      print "Loading cached decision surface ", fname
+      return np.load(fname)
 
+  x_min, x_max, y_min, y_max = bounds
+  step = 1
+  while step*2 <= size // coarse:   #power of two, so cells split evenly
+    step *= 2
+  n = -(-size // step) * step       #lattice covers size, multiple of step
+  xs = x_min + (x_max - x_min) * np.arange(n+1) / float(size)
+  ys = y_min + (y_max - y_min) * np.arange(n+1) / float(size)
+  L = np.empty( (n+1, n+1), dtype=int )  #labels at lattice points (rows are y)
+  Z = np.empty( (n, n), dtype=int )
+  done = np.zeros( (n, n), dtype=bool )
 
-def classify_pixels(eoName, irName, reducer, model, colors=None):
-  """ Creates and returns a PIL image with classes based on pixel values """ 
-  #grab pixel values from images
-  eo = Image.open(eoName)
-  ir = Image.open(irName)
-  eoPix = np.float32(eo) / 255.0
-  irPix = np.float32(ir) / 255.0
-  eoDat = eoPix.reshape( (eoPix.shape[0]*eoPix.shape[1], eoPix.shape[2]) )
-  eoDat = eoDat[:,:3]
-  irDat = irPix.reshape( (irPix.shape[0]*irPix.shape[1], 1) )
+  def evaluate(rows, cols):
+    L[rows, cols] = clf.predict(np.c_[xs[cols], ys[rows]])
 
-  #zip pixels into (IR, R, G, B) intensities
-  pixels = np.column_stack( (irDat, eoDat) )
-  X = reducer.features(pixels)
+  #coarse lattice
+  r, c = np.mgrid[0:n+1:step, 0:n+1:step]
+  evaluate(r.ravel(), c.ravel())
+  while True:
+    G = L[::step, ::step]
+    uniform = (G[:-1,:-1] == G[1:,:-1]) & (G[:-1,:-1] == G[:-1,1:]) & (G[:-1,:-1] == G[1:,1:])
+    #filled cells have unevaluated lattice points, never split them
+    uniform |= done[::step, ::step]
+    if step == 1:
+      uniform[...] = True
+    fill = np.repeat(np.repeat(uniform, step, 0), step, 1) & ~done
+    Z[fill] = np.repeat(np.repeat(G[:-1,:-1], step, 0), step, 1)[fill]
+    done |= fill
+    if step == 1:
+      break
 
-  #predict each pixel
-  probs = np.array(model.predict_proba(X))
-  Z = probs.argmax(1) #grab max value
+    #lattice points of the split cells at half the spacing (skip known ones)
+    half = step // 2
+    nb = uniform.shape[0]
+    M = np.zeros( (2*nb+1, 2*nb+1), dtype=bool )
+    for di in range(3):
+      for dj in range(3):
+        M[di:di+2*nb:2, dj:dj+2*nb:2] |= ~uniform
+    M[::2, ::2] = False
+    r, c = np.nonzero(M)
+    if len(r):
+      evaluate(r*half, c*half)
+    step = half
+
+  Z = Z[:size, :size]
+  if cache_dir:
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    np.save(fname, Z)
+  return Z
+
+
+def classify_pixels(eoName, irName, reducer, model, colors=None, tileRows=None, lut=None, smoother=None):
+  """ Creates and returns a PIL image with classes based on pixel values 
+      eoName/irName can be file names or already decoded uint8 arrays.
+      With tileRows set, the image is classified in blocks of that many rows
+      written into a preallocated uint8 label image, so peak memory is
+      bounded by the tile size instead of the image size.
+      With a lut (lut.PixelLUT), pixels are classified by table lookup.
+      With a smoother (smoothing.ProbSmoother), labels come from the 
+      spatially smoothed probabilities (tiles are padded by its halo).
+  """ 
+  #grab pixel values from images (still 8 bit)
+  eo = load_pixels(eoName)
+  ir = load_pixels(irName)
+  nrows, ncols = ir.shape[0], ir.shape[1]
+  if not tileRows:
+    tileRows = nrows
+
+  #classify each block of rows
+  Z = np.empty( (nrows, ncols), dtype=np.uint8 )
+  for r0 in range(0, nrows, tileRows):
+    r1 = min(nrows, r0+tileRows)
+    if smoother:
+      h0, h1 = max(0, r0-smoother.halo), min(nrows, r1+smoother.halo)
+      if lut:
+        P = lut.proba(eo[h0:h1], ir[h0:h1])
+      else:
+        P = classify_proba_block(eo[h0:h1], ir[h0:h1], reducer, model)
+      Z[r0:r1] = smoother.labels(P)[r0-h0:r1-h0]
+    elif lut:
+      Z[r0:r1] = lut.classify(eo[r0:r1], ir[r0:r1])
+    else:
+      Z[r0:r1] = classify_block(eo[r0:r1], ir[r0:r1], reducer, model)
 
   #greyscale image (just class values)
   if not colors:
-    img = Z.reshape(irPix.shape).astype("uint8")
-    return Image.fromarray(img)
+    return Image.fromarray(Z)
 
   #color image (color per class)
-  numClasses = len(set(Z))
-  print "EO Array shape", eoDat.shape
-  print "EO Img shape: ", eoPix.shape
-  cImg = np.zeros(eoDat.shape, dtype="uint8")
-  for c in range(numClasses):
-    print "Class %d, color %s"%(c, colors[c])
-    cImg[Z==c] = ImageColor.getrgb(colors[c])
-  cImg = cImg.reshape( (eoPix.shape[0], eoPix.shape[1], 3) ).astype("uint8")
-  return Image.fromarray(cImg)
+  palette = np.zeros( (256, 3), dtype=np.uint8 )
+  for c, color in enumerate(colors):
+    palette[c] = ImageColor.getrgb(color)
+  return Image.fromarray(palette[Z])
+
+def load_pixels(img):
+  """ uint8 pixel array for an image file name (arrays pass through) """
+  if isinstance(img, np.ndarray):
+    return img
+  return np.asarray(Image.open(img))
+
+def block_pixels(eo, ir):
+  """ (IR, R, G, B) float32 pixel matrix for a block of 8 bit EO/IR rows """
+  npix = ir.shape[0]*ir.shape[1]
+  pixels = np.empty( (npix, 4), dtype=np.float32 )
+  pixels[:,0] = ir.reshape(npix)
+  pixels[:,1:] = eo.reshape( (npix, eo.shape[2]) )[:,:3]
+  pixels /= 255.0
+  return pixels
+
+def classify_proba_block(eo, ir, reducer, model):
+  """ float32 class probabilities (rows x cols x classes) for a block of 8 bit EO/IR rows """
+  X = reducer.features(block_pixels(eo, ir))
+  probs = np.asarray(model.predict_proba(X), dtype=np.float32)
+  return probs.reshape( ir.shape[:2] + (probs.shape[1],) )
+
+def classify_block(eo, ir, reducer, model):
+  """ uint8 class labels for a block of 8 bit EO/IR rows """
+  X = reducer.features(block_pixels(eo, ir))
+
+  #predict each pixel
+  probs = np.array(model.predict_proba(X))
+  Z = probs.argmax(1) #grab max value
+  return Z.reshape(ir.shape[:2]).astype(np.uint8)
+
+
+# Check: a single straight boundary evaluates O(perimeter) lattice points
+if __name__ == "__main__":
+  class VerticalBoundary:
+    def __init__(self, labels):
+      self.labels = labels
+      self.evaluated = 0
+    def predict(self, x):
+      self.evaluated += len(x)
+      return np.where(x[:,0] < .3, self.labels[0], self.labels[1])
 
+  size = 512
+  for labels in ((0, 1), (1, 2), (7, 3)):
+    clf = VerticalBoundary(labels)
+    Z = decision_surface(clf, (0., 1., 0., 1.), size)
+    print "labels %s: %d of %d points evaluated"%(labels, clf.evaluated, (size+1)**2)
+    assert clf.evaluated < 16*size, "refinement is not following the boundary"
+    xs = np.arange(size) / float(size)
+    assert (Z == clf.predict(np.c_[xs, xs])[np.newaxis,:]).all()
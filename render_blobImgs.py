@@ -4,7 +4,8 @@ from bbas_adaptor import *;
 from change.helpers import *;
 from os.path import basename, splitext; 
 from glob import glob; 
-import random, os, sys, numpy, pylab, scene_registry;  
+import random, os, sys, numpy, pylab, hashlib, shutil, tempfile, scene_registry;  
+from PIL import Image
 from optparse import OptionParser
 
 ####################################################### 
@@ -21,6 +22,10 @@ parser.add_option("-o", "--gt",    action="store_true",           dest="gt",
 parser.add_option("-n", "--nvals", action="store", type="string", dest="nvals", default="135",  help="specify n values (1, 13, 35, 135, etc)")
 parser.add_option("-i", "--imgType",action="store", type="string", dest="imgType", default="png",  help="specify type of input images (for visualization, png, tif, tiff, etc)");
 parser.add_option("-l", "--kl_thresh",action="store",type="float", dest="kl_thresh",default=.2, help="specify KL Elimination min value (percent of max kl score necessary to still register as change)")
+parser.add_option("-c", "--klCache",action="store",type="string", dest="klCache",default=None, help="directory caching the KL expected/input gradient magnitudes across runs (keyed by camera and scene version)")
+parser.add_option("-u", "--sweep", action="store_true",           dest="sweep", default=False,  help="experimental: blob images of all thresholds from one numpy union-find sweep instead of blob_change_detection per threshold (check parity with -v first)")
+parser.add_option("-m", "--minBlob",action="store",type="int", dest="minBlob",default=1, help="smallest blob (pixels) kept by the union-find sweep")
+parser.add_option("-v", "--verify",action="store",type="int",    dest="verify",default=0,      help="with -u, compare the sweep against blob_change_detection on this many frames (first/middle/last threshold)")
 (options, args) = parser.parse_args()
 print options
 print args
@@ -62,6 +67,7 @@ elif options.type in ["", "raybelief", "twopass"] :
   CHANGE_IMG_DIRS = [ "change_imgs/results_" + MODEL + "_" + options.type]
   print "Generating blob images for change type: ", options.type
 USE_DEPTH_THRESH = False;
+USE_SWEEP = options.sweep and not USE_DEPTH_THRESH  #the sweep has no depth test
 ########################################################
 
 #################################
@@ -115,50 +121,226 @@ for imgDir in CHANGE_IMG_DIRS :
       result_dirs.append(resDir) # += glob( os.getcwd() + "/" + imgDir + "/*" ); 
 result_dirs.sort(); 
 print result_dirs
+##############################################################
+#threshold independent KL inputs (expected image gradient and input
+#gradient magnitudes), computed once per frame and shared by every
+#threshold and cd_NxN directory.  With -c they are also stored on disk,
+#keyed by the camera file and the scene version, for later runs.
+##############################################################
+def scene_version(scene_path):
+  """ hash of the scene xml and the modification times of the model files """
+  sceneDir = os.path.dirname(scene_path)
+  h = hashlib.sha1( open(scene_path).read() )
+  for f in sorted( os.listdir(sceneDir) ):
+    h.update( "%s:%f"%(f, os.path.getmtime(os.path.join(sceneDir, f))) )
+  return h.hexdigest()
+
+class KLInputs:
+  def __init__(self, scene, cacheDir=None, version=""):
+    self.scene = scene
+    self.cacheDir = cacheDir
+    self.version = version
+    self.idx = None
+    self.mags = None
+    if cacheDir and not os.path.exists(cacheDir):
+      os.makedirs(cacheDir)
+
+  def key(self, camFile, inFile):
+    h = hashlib.sha1( self.version + open(camFile).read() + open(inFile, 'rb').read() )
+    return h.hexdigest()
+
+  def get(self, idx, inImg):
+    """ (inMag, expMag) for frame idx, computed at most once per frame """
+    if self.idx == idx:
+      return self.mags
+    self.release()
+    if self.cacheDir:
+      base = os.path.join(self.cacheDir, self.key(incams[idx], inimgs[idx]))
+      if os.path.exists(base + "_expMag.tiff"):
+        inMag, ni, nj = load_image(base + "_inMag.tiff")
+        expMag, ni, nj = load_image(base + "_expMag.tiff")
+        self.idx, self.mags = idx, (inMag, expMag)
+        return self.mags
+
+    #gradient on input image
+    greyImg = convert_image(inImg, "grey"); 
+    inDx, inDy, inMag = gradient(greyImg); 
+    #expected image gradient
+    inCam  = load_perspective_camera(incams[idx]); 
+    expImg = self.scene.render(inCam); 
+    expDx, expDy, expMag = gradient(expImg); 
+    remove_from_db( [greyImg, inDx, inDy, expImg, expDx, expDy] );
+    if self.cacheDir:
+      save_image(inMag, base + "_inMag.tiff")
+      save_image(expMag, base + "_expMag.tiff")
+    self.idx, self.mags = idx, (inMag, expMag)
+    return self.mags
+
+  def release(self):
+    if self.mags:
+      remove_from_db( list(self.mags) )
+    self.idx, self.mags = None, None
+
+klInputs = None
+if DO_KL_ELIMINATION:
+  klInputs = KLInputs(scene, options.klCache, scene_version(scene_path))
+
+##############################################################
+#blob images of all thresholds in one pass (instead of one
+#blob_change_detection per threshold).  The 8 connected edge between two
+#neighboring pixels is active for every thresh <= the smaller of their
+#scores, so each edge is bucketed once by the highest threshold it is
+#active at, and the buckets are merged from the highest threshold down
+#with a vectorized union-find: every edge is hooked once, no threshold
+#is relabeled from scratch.
+#Opt in with -u: the default stays blob_change_detection until -v shows
+#the sweep matches its blob processing and pixel type.
+##############################################################
+def threshold_edges(score, threshes):
+  """ (a, b, k) flat pixel indices of every 8 connected neighbor pair and
+      the index k (into sorted threshes) of the highest threshold it is
+      active at, pairs active at no threshold dropped """
+  nr, nc = score.shape
+  I = numpy.arange(nr*nc, dtype=numpy.int32).reshape(nr, nc)
+  slices = [ ((slice(None), slice(None,-1)),   (slice(None), slice(1,None))),
+             ((slice(None,-1), slice(None)),   (slice(1,None), slice(None))),
+             ((slice(None,-1), slice(None,-1)), (slice(1,None), slice(1,None))),
+             ((slice(None,-1), slice(1,None)), (slice(1,None), slice(None,-1))) ]
+  A, B, K = [], [], []
+  for sa, sb in slices:
+    k = numpy.searchsorted(threshes, numpy.minimum(score[sa], score[sb]).ravel(), side="right") - 1
+    active = k >= 0
+    A.append( I[sa].ravel()[active] )
+    B.append( I[sb].ravel()[active] )
+    K.append( k[active] )
+  return numpy.concatenate(A), numpy.concatenate(B), numpy.concatenate(K)
+
+def compress(parent):
+  """ pointer jumping until every pixel points at its root """
+  while True:
+    grand = parent[parent]
+    if numpy.array_equal(grand, parent):
+      return parent
+    parent = grand
+
+def hook(parent, a, b):
+  """ union of the components of every (a, b) pair, parent is kept
+      compressed (parent[x] is the root of x) """
+  while len(a):
+    ra, rb = parent[a], parent[b]
+    keep = ra != rb
+    a, b, ra, rb = a[keep], b[keep], ra[keep], rb[keep]
+    #larger root points at the smaller one, pairs losing a write conflict
+    #are merged in the next round
+    parent[numpy.maximum(ra, rb)] = numpy.minimum(ra, rb)
+    parent = compress(parent)
+  return parent
+
+def blob_sweep(score, threshes, minBlob=1):
+  """ (thresh index, uint8 blob mask) for every threshold, highest first.
+      Blob pixels (255) are >= thresh and in an 8 connected component of
+      at least minBlob pixels (components are only built for minBlob > 1) """
+  order = numpy.argsort(threshes)
+  flat = score.ravel()
+  if minBlob > 1:
+    a, b, k = threshold_edges(score, numpy.asarray(threshes)[order])
+    parent = numpy.arange(len(flat), dtype=numpy.int32)
+  for j in range(len(order)-1, -1, -1):
+    thresh = threshes[order[j]]
+    fg = flat >= thresh
+    if minBlob > 1:
+      new = numpy.nonzero(k == j)[0]
+      parent = hook(parent, a[new], b[new])
+      roots = parent[fg]
+      fg[fg] = numpy.bincount(roots, minlength=len(flat))[roots] >= minBlob
+    yield order[j], numpy.where(fg, 255, 0).astype(numpy.uint8).reshape(score.shape)
+
+def load_blob_image(mask, fname):
+  """ blob mask as a database image (through a temporary file) """
+  Image.fromarray(mask).save(fname)
+  bimg, ni, nj = load_image(fname)
+  return bimg
+
+def verify_blobs(cimg, mask, thresh, tmpName):
+  """ prints how many pixels (and which pixel type) the sweep and
+      blob_change_detection disagree on """
+  bimg = blob_change_detection(cimg, thresh)
+  save_image(bimg, tmpName)
+  remove_from_db( [bimg] )
+  ref = Image.open(tmpName)
+  refPix = numpy.asarray(ref)
+  print "  verify thresh %.3f: %d of %d pixels differ from blob_change_detection (%s %s, sweep uint8 0/255)"%(
+        thresh, numpy.sum((refPix > 0) != (mask > 0)), mask.size, ref.mode, numpy.unique(refPix)[:4])
+  os.remove(tmpName)
+
+#per directory change images and per threshold output dirs
+threshes = numpy.arange(LOWER, UPPER, STEP)
+dirImgs = {}
+dirOutdirs = {}
 for d in result_dirs: 
-  print "Rendering blob images for ", d
   #make appropriate dir 
   splitpath = d.split('/'); 
   imDir = blobDir + splitpath[-2] + "_" + splitpath[-1] + "/"; 
   if not os.path.exists(imDir) :
     os.makedirs(imDir);   
 
-  #render thresholded images
-  for thresh in numpy.arange(LOWER, UPPER, STEP): 
+  #one output dir per threshold
+  outdirs = []
+  for thresh in threshes:
     if DO_KL_ELIMINATION:
       outdir = imDir + "/blobs_kl_" + str(thresh) + "/"; 
     else:
       outdir = imDir + "/blobs_" + str(thresh) + "/"; 
     if not os.path.exists(outdir) :
       os.makedirs(outdir); 
+    outdirs.append(outdir)
+  dirOutdirs[d] = outdirs
+  dirImgs[d] = glob(d + "/*.tiff"); dirImgs[d].sort()
 
-    #load up change images
-    imgs  = glob(d + "/*.tiff"); imgs.sort()
-    for idx, img in enumerate(imgs):
-      
-      #load input image (new frame)
-      inImg, ni, nj = load_image(inimgs[idx]); 
-      
-      #load change image
+#scratch files of the sweep's masks (handed to the adaptor by file)
+tmpDir = tempfile.mkdtemp(prefix="blobs_") if USE_SWEEP else None
+
+#frame major: load each input image (and depth pair) once, then render the
+#blob images of every result directory and threshold from it
+nFrames = max( [len(imgs) for imgs in dirImgs.values()] + [0] )
+for idx in range(nFrames):
+  print "Rendering blob images for frame ", inimgs[idx]
+  inImg, ni, nj = load_image(inimgs[idx]); 
+  if USE_DEPTH_THRESH :
+    d1,ni,nj   = load_image(dimgs1[idx]); 
+    d2,ni,nj   = load_image(dimgs2[idx]); 
+
+  for d in result_dirs:
+    if idx >= len(dirImgs[d]):
+      continue
+    img = dirImgs[d][idx]
+    imgnum, ext = os.path.splitext( basename(img) ); 
+    cimg,ni,nj = load_image(img); 
+
+    #blob images of every threshold (one union-find sweep with -u)
+    if USE_SWEEP:
+      score = numpy.asarray(Image.open(img), dtype=numpy.float32)
+      blobs = blob_sweep(score, threshes, options.minBlob)
+    else:
+      blobs = ( (t, None) for t in range(len(threshes)) )
+    verify = set()
+    if idx < options.verify and USE_SWEEP:
+      verify = set([0, len(threshes)//2, len(threshes)-1])
+
+    for t, mask in blobs:
+      thresh, outdir = threshes[t], dirOutdirs[d][t]
       if USE_DEPTH_THRESH :
-        d1,ni,nj   = load_image(dimgs1[idx]); 
-        d2,ni,nj   = load_image(dimgs2[idx]); 
-        cimg,ni,nj = load_image(img); 
         bimg       = blob_change_detection( cimg, thresh, d1, d2)
-      else : 
-        cimg,ni,nj = load_image(img); 
+      elif USE_SWEEP :
+        if t in verify:
+          verify_blobs(cimg, mask, thresh, os.path.join(tmpDir, "brip.tiff"))
+        bimg       = load_blob_image(mask, os.path.join(tmpDir, "blob.png"))
+      else :
         bimg       = blob_change_detection( cimg, thresh)
 
-      #do KL div based blob pruning
+      #do KL div based blob pruning (gradients are shared by all thresholds)
       if DO_KL_ELIMINATION :
-        #gradient on input image
-        greyImg = convert_image(inImg, "grey"); 
-        inDx, inDy, inMag = gradient(greyImg); 
-        #expected image gradient
-        inCam  = load_perspective_camera(incams[idx]); 
-        expImg = scene.render(inCam); 
-        expDx, expDy, expMag = gradient(expImg); 
-        #kl img and new blob img
+        inMag, expMag = klInputs.get(idx, inImg)
         kl_img, new_blobs = blobwise_kl_div(inMag, expMag, bimg, kl_thresh); 
         oldB = bimg;
         bimg = new_blobs
@@ -169,15 +351,24 @@ for d in result_dirs:
 
       ################################
       # save vis image in new blob img dir
-      imgnum, ext = os.path.splitext( basename(img) ); 
       img_name  = outdir + "/" + imgnum + ".png"; 
       save_image(vis_img, img_name); 
       if DO_KL_ELIMINATION and SAVE_KL:
         save_image(kl_img, outdir + "/kl_" + imgnum + ".tiff");
 
       #######################
-      #clean up images 
-      remove_from_db( [inImg, cimg, vis_img] );
+      #clean up this threshold's images
+      remove_from_db( [bimg, vis_img] );
       if DO_KL_ELIMINATION :
-        remove_from_db( [greyImg, inDx, inDy, inMag, expImg, expDx, expDy, expMag, kl_img, new_blobs, oldB]);
-  
+        remove_from_db( [kl_img, oldB] );
+    remove_from_db( [cimg] );
+
+  #######################
+  #clean up frame images
+  remove_from_db( [inImg] );
+  if USE_DEPTH_THRESH :
+    remove_from_db( [d1, d2] );
+  if klInputs :
+    klInputs.release()
+if tmpDir:
+  shutil.rmtree(tmpDir)
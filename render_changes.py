@@ -2,7 +2,8 @@ from boxm2_scene_adaptor import *;
 from change.helpers import *;
 from os.path import basename, splitext; 
 from glob import glob; 
-import random, os, sys, numpy, pylab, scene_registry
+import random, os, sys, numpy, pylab, threading, Queue, scene_registry
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 
 ####################################################### 
@@ -88,12 +89,104 @@ assert len(imgs) == len(cams)
 ###########################################################
 # render change img/cam pairs for each neighborhood value
 # save images in <model_dir>/change/change_imgs/results_<model_type>_<change_type>/cd_NxN/
+#
+# One visit per frame: the image/camera are loaded and the expected image
+# rendered once, then every (change type, n) change image is computed from
+# them.  The next frame is prefetched on a thread and change images are
+# handed to a writer thread.  Adaptor (batch database) calls, including
+# save_image, are serialized with BATCH_LOCK, so only the raw file
+# read-ahead of the next frame overlaps the GPU work; writes do not.  A
+# failed write stops the writer and is re-raised in the main thread.
 ###########################################################
+BATCH_LOCK = threading.Lock()
+writeErrors = []
+
+def read_ahead(fname):
+  """ pulls a file into the OS page cache (no adaptor call) """
+  f = open(fname, 'rb')
+  while f.read(1<<20):
+    pass
+  f.close()
+
+def load_frame(idx):
+  """ prefetch thread: input image and camera of frame idx """
+  read_ahead(imgs[idx])
+  read_ahead(cams[idx])
+  with BATCH_LOCK:
+    rimg, ni, nj = load_image(imgs[idx])
+    pcam = load_perspective_camera(cams[idx])
+  return idx, rimg, ni, nj, pcam
+
+def writer(queue):
+  """ writer thread: saves (image, file name) items until None, stops at
+      the first error (kept in writeErrors) """
+  try:
+    while True:
+      item = queue.get()
+      if item is None:
+        break
+      img, fname = item
+      with BATCH_LOCK:
+        save_image(img, fname)
+        remove_from_db( [img] )
+  except Exception:
+    writeErrors.append( sys.exc_info() )
+
+def raise_write_error():
+  if writeErrors:
+    errType, err, tb = writeErrors[0]
+    raise errType, err, tb
+
+def queue_write(item):
+  """ queues item for the writer, raising its error instead of blocking
+      forever on a full queue once it has died """
+  while True:
+    raise_write_error()
+    if not writeThread.is_alive():
+      raise RuntimeError("change image writer thread stopped")
+    try:
+      writeQueue.put(item, timeout=1.0)
+      return
+    except Queue.Full:
+      pass
+
+#output dirs for every (change type, n) combination
+outRoot = scene_root + "/change/change_imgs/"
+combos = []
 for CHANGETYPE in CHANGETYPES :
-  outRoot = scene_root + "/change/change_imgs/"
   for n in ns: 
     outdir = outRoot + "results_" + MODEL + "_" + CHANGETYPE + "/cd_%(#)dx%(#)d/"%{"#":n}; 
-    render_changes(scene, imgs, cams, outdir, n, CHANGETYPE); 
+    if not os.path.exists(outdir):
+      os.makedirs(outdir)
+    combos.append( (CHANGETYPE, n, outdir) )
+
+writeQueue = Queue.Queue(maxsize=2*len(combos))
+writeThread = threading.Thread(target=writer, args=(writeQueue,))
+writeThread.start()
+loader = ThreadPool(1)
+pending = loader.apply_async(load_frame, (0,)) if len(imgs) else None
+try:
+  while pending:
+    idx, rimg, ni, nj, pcam = pending.get()
+    pending = loader.apply_async(load_frame, (idx+1,)) if idx+1 < len(imgs) else None
+    imgnum, ext = os.path.splitext( basename(imgs[idx]) ); 
+    print "change detection for ", imgs[idx]
+
+    #render expected image once, then every change type/neighborhood
+    with BATCH_LOCK:
+      expimg = scene.render(pcam, ni, nj); 
+    for CHANGETYPE, n, outdir in combos:
+      with BATCH_LOCK:
+        cd_img = scene.change_detect(pcam, rimg, expimg, n, CHANGETYPE); 
+      queue_write( (cd_img, outdir + imgnum + ".tiff") )
+    with BATCH_LOCK:
+      remove_from_db( [rimg, expimg] ); 
+finally:
+  loader.close()
+  queue_write(None)
+  writeThread.join()
+#errors of the last queued writes
+raise_write_error()
 
 
 ####
@@ -7,14 +7,61 @@ from os.path import basename, splitext;
 import numpy
 import pylab
 from glob import glob; 
+from collections import OrderedDict
 from change.helpers import *
 
 #################################
 # Set some update parameters
 GPU = True;
 RGB = False;
+HALF_WINDOW = 2;    #update with HALF_WINDOW previous and next frames
+SLIDING = False;    #sliding window mode (see below)
 #################################
 
+#################################
+# Appearance update window per change image.
+#  default: the scene is updated with the frames in
+#           [idx-HALF_WINDOW, idx+HALF_WINDOW] (minus idx itself), change
+#           detection is run, then scene.clear_cache() drops the updates.
+#  SLIDING: boxm2 updates can't be subtracted again, so a frame leaving the
+#           window can't be removed and the current frame must never be
+#           added before its own change detection.  The window is made
+#           causal instead: after frame idx is processed it is the only
+#           frame added to the scene (one update per frame, no clear_cache),
+#           and old frames fade out through the online appearance model.
+# Loaded images and cameras are kept in a small LRU, so each frame is read
+# from disk once.
+#################################
+class FrameCache:
+  def __init__(self, imgs, cams, size):
+    self.imgs = imgs
+    self.cams = cams
+    self.size = size
+    self.frames = OrderedDict()
+
+  def get(self, i):
+    """ (camera, image) of frame i, loading it on a miss """
+    if i in self.frames:
+      frame = self.frames.pop(i)
+    else:
+      pcam        = load_perspective_camera(self.cams[i]); 
+      img, ni, nj = load_image (self.imgs[i]); 
+      frame = (pcam, img)
+    self.frames[i] = frame
+    while len(self.frames) > self.size:
+      oldIdx, (oldCam, oldImg) = self.frames.popitem(last=False)
+      remove_from_db([oldCam, oldImg])
+    return frame
+
+  def clear(self):
+    for pcam, img in self.frames.values():
+      remove_from_db([pcam, img])
+    self.frames.clear()
+
+def update_frame(scene, frames, i):
+  pcam, img = frames.get(i)
+  scene.update(pcam, img, False);  #false=dont update alpha
+
 #load up opencl scene
 scene_path = "../model/rscene.xml";  
 scene = boxm2_scene_adaptor(scene_path, RGB, "gpu");  
@@ -25,6 +72,7 @@ move_appearance( os.getcwd() + "/../model/");
 #grab all change images
 allImgs = glob(os.getcwd() + "/imgs/*.png"); allImgs.sort(); 
 allCams = glob(os.getcwd() + "/cams_krt/*.txt"); allCams.sort(); 
+frames = FrameCache(allImgs, allCams, 2*HALF_WINDOW+1)
 
 #load up GT images, grab the corresponding imgs and cams
 #gts = glob(os.getcwd() + "/gt/*.png"); gts.sort(); 
@@ -35,23 +83,24 @@ for idx, img in enumerate(allImgs):
   cimg = os.getcwd() + "/imgs/" + imgnum + ".png"; 
   ccam = os.getcwd() + "/cams_krt/" + imgnum + "_cam.txt"; 
   
-  #find image in list, update w/ two previous, two next
+  #find image in list, update w/ previous and next frames
   currIdx = idx;
-  for i in range(currIdx-2, currIdx+2) :
-    if i<0 or i>=len(allImgs) or i==currIdx: continue
-    pcam        = load_perspective_camera(allCams[i]); 
-    img, ni, nj = load_image (allImgs[i]); 
-    scene.update(pcam, img, False);  #false=dont update alpha
+  if not SLIDING:
+    for i in range(currIdx-HALF_WINDOW, currIdx+HALF_WINDOW+1) :
+      if i<0 or i>=len(allImgs) or i==currIdx: continue
+      update_frame(scene, frames, i)
   
   n=5; 
   outdir = os.getcwd() + "/results_app/cd_%(#)dx%(#)d/"%{"#":n}; 
   render_changes(scene, cimg, ccam, outdir, n, "raybelief"); 
   
-  #clear those last 4 updates
-  scene.clear_cache(); 
+  if SLIDING:
+    #frame enters the (causal) window once it has been change detected
+    update_frame(scene, frames, currIdx)
+  else:
+    #clear the window updates
+    scene.clear_cache(); 
+frames.clear()
     
 # move appearance back
-return_appearance( os.getcwd() + "/../model/"); 
-
-
-
+return_appearance( os.getcwd() + "/../model/");